@@ -4,18 +4,35 @@ Main Flask application for network device registration
 """
 
 import os
+import re
 import logging
 import subprocess
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import threading
+from functools import lru_cache
+from cachetools import TTLCache, cached
+from types import MappingProxyType
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, flash, jsonify, g
+from flask_sqlalchemy.record_queries import get_recorded_queries
+from kombu.exceptions import OperationalError as BrokerError
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from sqlalchemy import event, func, text, update
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
+from sqlalchemy.orm import Session, aliased, contains_eager, joinedload, load_only, raiseload, selectinload
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import date, datetime, timedelta
 import secrets
+import base64
+import binascii
 
 from models import db, User, Device, RegistrationRequest, VlanMapping, Setting
-from radius_coa import send_coa_disconnect, send_coa_change
-from email_service import send_verification_email, send_admin_notification, send_wifi_registration_confirmation
+from radius_coa import send_coa_change
 from kea_integration import get_kea_client
+from tasks import (
+    KEA_SOCKET, send_verification_email_task, send_admin_notification_task, send_wifi_confirmation_task,
+    send_coa_change_batch_task, send_coa_disconnect_task, disconnect_device_task,
+    register_kea_mac_task, unregister_kea_mac_task
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,17 +40,41 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+# Trust the forwarding headers set by the reverse proxy (NPM) in front of the portal
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'postgresql://portal_user:password@db:5432/captive_portal')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Opt-in query counting to catch N+1 regressions (see warn_on_query_count)
+app.config['SQLALCHEMY_RECORD_QUERIES'] = os.getenv('SQLALCHEMY_RECORD_QUERIES') == '1'
+QUERY_WARN_THRESHOLD = int(os.getenv('QUERY_WARN_THRESHOLD', '10'))
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        # Sized for gevent workers, where many greenlets share one process's pool
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '20')),
+        # Give up on checkout quickly when the pool is exhausted rather than queueing for 30s
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '5')),
+        # Detect connections dropped by a database restart before handing them out
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        # Fail fast when the database is unreachable instead of hanging a worker (and the health probe)
+        'connect_args': {'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '2'))}
+    }
 
 # Initialize database
 db.init_app(app)
 
-# Initialize Kea client for WiFi registrations
-KEA_SOCKET = os.getenv('KEA_CONTROL_SOCKET', '/kea/leases/kea4-ctrl-socket')
+# Initialize Kea client for WiFi registrations (same control socket as the worker, see tasks.KEA_SOCKET)
 kea_client = None
 
+# Links sent in emails, built from the public portal URL
+PORTAL_URL = os.getenv('PORTAL_URL', '').rstrip('/')
+VERIFY_URL = (PORTAL_URL + '/verify?token={}').format
+UNREGISTER_URL = (PORTAL_URL + '/unregister/{}').format
+APPROVAL_URL = (PORTAL_URL + '/admin/approve/{}').format
+WIFI_EMAIL_NOT_SENT = 'Your device is registered, but the confirmation email could not be sent.'
+
 # Initialize login manager
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -42,36 +83,30 @@ login_manager.login_view = 'admin_login'
 # VLAN configuration - load from database with fallback to env vars
 def get_vlan_map():
     """Get VLAN mappings from database"""
-    mappings = VlanMapping.query.all()
-    if mappings:
-        return {m.status: m.vlan_id for m in mappings}
-    
-    # Fallback to environment variables if database is empty
-    return {
-        'friars': int(os.getenv('VLAN_FRIARS', 10)),
-        'staff': int(os.getenv('VLAN_STAFF', 20)),
-        'students': int(os.getenv('VLAN_STUDENTS', 30)),
-        'guests': int(os.getenv('VLAN_GUESTS', 40)),
-        'contractors': int(os.getenv('VLAN_CONTRACTORS', 50)),
-        'volunteers': int(os.getenv('VLAN_VOLUNTEERS', 60)),
-        'iot': int(os.getenv('VLAN_IOT', 70)),
-        'restricted': int(os.getenv('VLAN_RESTRICTED', 90)),
-        'unregistered': int(os.getenv('VLAN_UNREGISTERED', 99)),
-    }
+    return VlanMapping.get_map()
+
+@lru_cache(maxsize=16)
+def parse_vlan_list(value):
+    """Parse a comma-separated VLAN setting into a frozenset (memoized per setting value)"""
+    return frozenset(int(v.strip()) for v in value.split(',') if v.strip())
 
 def get_auto_approve_vlans():
-    """Get list of VLANs that auto-approve from settings"""
-    auto_approve_str = Setting.get_value('auto_approve_vlans', '40,30,60')
-    return [int(v.strip()) for v in auto_approve_str.split(',') if v.strip()]
+    """Get the set of VLANs that auto-approve from settings"""
+    return parse_vlan_list(Setting.get_value('auto_approve_vlans', '40,30,60'))
 
 def get_admin_approval_vlans():
-    """Get list of VLANs that require admin approval from settings"""
-    admin_approval_str = Setting.get_value('admin_approval_vlans', '10,20,50')
-    return [int(v.strip()) for v in admin_approval_str.split(',') if v.strip()]
+    """Get the set of VLANs that require admin approval from settings"""
+    return parse_vlan_list(Setting.get_value('admin_approval_vlans', '10,20,50'))
 
 # Admin user (simple single admin - extend for multiple admins)
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
-ADMIN_PASSWORD_HASH = os.getenv('ADMIN_PASSWORD_HASH', generate_password_hash('admin123'))
+ADMIN_PASSWORD_HASH = os.getenv('ADMIN_PASSWORD_HASH')
+
+
+@lru_cache(maxsize=1)
+def get_admin_password_hash():
+    """Return the configured admin password hash, hashing the default password on first use"""
+    return ADMIN_PASSWORD_HASH or generate_password_hash('admin123')
 
 
 class AdminUser:
@@ -100,6 +135,87 @@ def load_user(user_id):
     return None
 
 
+# Kea lease files (CSV), searched in order
+# Format: address,hwaddr,client_id,valid_lifetime,expire,subnet_id,fqdn_fwd,fqdn_rev,hostname,state,user_context,pool_id
+LEASE_FILES = [
+    '/kea/leases/kea-leases4.csv',
+    '/kea/leases/kea-leases4.csv.2',
+    '/kea/leases/kea-leases4.csv.1'
+]
+
+# Parsed lease files: path -> (inode, size, mtime_ns, parsed_bytes, tail, {ip: mac}),
+# where tail holds the last bytes parsed so a file rewritten in place is noticed
+LEASE_CACHE = {}
+LEASE_TAIL_BYTES = 64
+LEASE_CACHE_LOCK = threading.Lock()
+
+
+def parse_leases(data, table):
+    """Add the address -> hwaddr pairs from complete CSV lines in data to table"""
+    # Decode the whole chunk once instead of two small decodes per row
+    for line in data.decode('ascii', 'replace').split('\n'):
+        # Only the first two fields are needed; partition avoids splitting the rest of the row.
+        # Kea escapes commas inside text fields (hostname, user_context) as "&#x2c",
+        # and address/hwaddr never contain one, so no CSV quoting rules are needed.
+        address, sep, rest = line.partition(',')
+        if not sep or address == 'address':
+            continue
+        table[address] = rest.partition(',')[0]
+
+
+def load_leases(path):
+    """
+    Return the IP -> MAC table for a Kea lease file.
+    
+    Kea appends a row for every lease change and only rewrites the file during
+    lease file cleanup, so only the bytes appended since the last call are parsed.
+    The file is re-read in full when it is replaced, shrinks, changes without
+    growing, or no longer holds the bytes parsed last time.
+    Later rows override earlier ones, so each IP maps to its most recent lease.
+    Missing files yield an empty table.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    
+    cached = LEASE_CACHE.get(path)
+    if cached and cached[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+        return cached[5]
+    
+    with LEASE_CACHE_LOCK:
+        cached = LEASE_CACHE.get(path)
+        with open(path, 'rb') as f:
+            # Describe the file actually opened, which may have replaced the one stat()ed above
+            st = os.fstat(f.fileno())
+            if cached and cached[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+                return cached[5]
+            
+            offset, tail, table = 0, b'', {}
+            if cached and cached[0] == st.st_ino and cached[1] < st.st_size:
+                # Same file, grown: parse only the new rows, unless the rows already
+                # parsed were rewritten (truncated in place and regrown)
+                parsed, old_tail = cached[3], cached[4]
+                f.seek(parsed - len(old_tail))
+                if f.read(len(old_tail)) == old_tail:
+                    offset, tail, table = parsed, old_tail, cached[5]
+                else:
+                    f.seek(0)
+            data = f.read()
+        
+        # Leave a partially written last line for the next call
+        complete = data.rfind(b'\n') + 1
+        parse_leases(data[:complete], table)
+        
+        tail = (tail + data[:complete])[-LEASE_TAIL_BYTES:]
+        LEASE_CACHE[path] = (st.st_ino, st.st_size, st.st_mtime_ns, offset + complete, tail, table)
+        return table
+
+
+# Translation table that strips MAC address separators in one pass
+MAC_SEPARATORS = str.maketrans('', '', ':-')
+
+
 def get_client_mac():
     """
     Extract MAC address from Kea lease database based on client IP.
@@ -116,71 +232,263 @@ def get_client_mac():
     if not mac:
         ip_address = get_client_ip()
         if ip_address:
-            try:
-                # Read Kea lease file directly (CSV format)
-                # Format: address,hwaddr,client_id,valid_lifetime,expire,subnet_id,fqdn_fwd,fqdn_rev,hostname,state,user_context,pool_id
-                lease_files = [
-                    '/kea/leases/kea-leases4.csv',
-                    '/kea/leases/kea-leases4.csv.2',
-                    '/kea/leases/kea-leases4.csv.1'
-                ]
+            # Try each lease file until we find the MAC
+            for lease_file in LEASE_FILES:
+                try:
+                    mac = load_leases(lease_file).get(ip_address)
+                except Exception as e:
+                    logger.error("Error reading Kea lease file %s: %s", lease_file, e)
+                    continue
                 
-                # Try each lease file until we find the MAC
-                for lease_file in lease_files:
-                    try:
-                        with open(lease_file, 'r') as f:
-                            for line in f:
-                                # Skip header line
-                                if line.startswith('address,'):
-                                    continue
-                                    
-                                fields = line.strip().split(',')
-                                if len(fields) >= 2:
-                                    lease_ip = fields[0]
-                                    lease_hwaddr = fields[1]
-                                    
-                                    # Check if IP matches
-                                    if lease_ip == ip_address:
-                                        # MAC address is in fields[1] in format xx:xx:xx:xx:xx:xx
-                                        mac = lease_hwaddr
-                                        logger.info(f"Found MAC {mac} for IP {ip_address} in Kea lease file {lease_file}")
-                                        break
-                        
-                        # If we found the MAC, stop searching other files
-                        if mac:
-                            break
-                            
-                    except FileNotFoundError:
-                        logger.debug(f"Kea lease file not found: {lease_file}")
-                        continue
-                    except Exception as e:
-                        logger.error(f"Error reading Kea lease file {lease_file}: {e}")
-                        continue
-                        
-            except Exception as e:
-                logger.error(f"Error looking up MAC address: {e}")
+                if mac:
+                    logger.info("Found MAC %s for IP %s in Kea lease file %s", mac, ip_address, lease_file)
+                    break
     
     # Normalize MAC address format
     if mac:
-        mac = mac.lower().replace('-', '').replace(':', '')
+        mac = mac.translate(MAC_SEPARATORS)
         if len(mac) == 12:
-            # Format as xx:xx:xx:xx:xx:xx
-            mac = ':'.join([mac[i:i+2] for i in range(0, 12, 2)])
+            try:
+                # Format as xx:xx:xx:xx:xx:xx (hex() emits lowercase)
+                return bytes.fromhex(mac).hex(':')
+            except ValueError:
+                pass
+        mac = mac.lower()
     
     return mac
 
 
+@app.before_request
+def init_query_cache():
+    """Start each request with an empty lookup cache"""
+    g.query_cache = {}
+
+
+@app.after_request
+def warn_on_query_count(response):
+    """Log requests that ran more queries than expected (only when query recording is enabled)"""
+    if app.config['SQLALCHEMY_RECORD_QUERIES']:
+        queries = get_recorded_queries()
+        if len(queries) > QUERY_WARN_THRESHOLD:
+            logger.warning("%s %s ran %s queries (threshold %s)",
+                           request.method, request.path, len(queries), QUERY_WARN_THRESHOLD)
+    return response
+
+
+def cached_first(model, **filters):
+    """
+    Return model.query.filter_by(**filters).first(), reusing the result for the rest of the request.
+    
+    The cache on g holds a strong reference, so the instance stays in the
+    session's identity map (which only keeps weak references).
+    """
+    key = (model, frozenset(filters.items()))
+    if key not in g.query_cache:
+        g.query_cache[key] = model.query.filter_by(**filters).first()
+    return g.query_cache[key]
+
+
+def get_device(mac_address):
+    """Look up a device by MAC address (cached for the request)"""
+    return cached_first(Device, mac_address=mac_address)
+
+
+def encode_token(token_bytes):
+    """Encode a binary token for use in a URL (unpadded base64url)"""
+    return base64.urlsafe_b64encode(token_bytes).rstrip(b'=').decode('ascii')
+
+
+def decode_token(token):
+    """
+    Decode a URL token back to bytes.
+    
+    Returns:
+        bytes, or None if the token is not valid base64url
+    """
+    try:
+        return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return None
+
+
+def upsert_device(values):
+    """
+    Insert a device, or update the existing row with the same MAC address.
+    
+    Uses INSERT ... ON CONFLICT (mac_address) DO UPDATE, so concurrent registrations
+    of one MAC cannot race between a lookup and an insert.
+    
+    Args:
+        values: Device column values, including mac_address
+    
+    Returns:
+        Device: the inserted or updated device
+    """
+    stmt = pg_insert(Device).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Device.mac_address],
+        set_={key: stmt.excluded[key] for key in values if key != 'mac_address'}
+    ).returning(Device)
+    return db.session.scalars(stmt, execution_options={'populate_existing': True}).one()
+
+
+# Detection probe results per MAC address, so repeated probes skip the database.
+# Registered devices are remembered for 30s. Unregistered devices, which probe most
+# often, are remembered for only 5s so a registration made in another worker shows up
+# quickly. This process forgets a MAC whenever it changes that device.
+ACTIVE_DEVICE_CACHE = TTLCache(maxsize=1024, ttl=30)
+INACTIVE_DEVICE_CACHE = TTLCache(maxsize=4096, ttl=5)
+ACTIVE_DEVICE_CACHE_LOCK = threading.Lock()
+
+
+def is_device_active(mac_address):
+    """Check whether a device is registered and active (cached briefly across requests)"""
+    with ACTIVE_DEVICE_CACHE_LOCK:
+        if mac_address in ACTIVE_DEVICE_CACHE:
+            return True
+        if mac_address in INACTIVE_DEVICE_CACHE:
+            return False
+    
+    device = get_device(mac_address)
+    active = device is not None and device.registration_status == 'active'
+    with ACTIVE_DEVICE_CACHE_LOCK:
+        (ACTIVE_DEVICE_CACHE if active else INACTIVE_DEVICE_CACHE)[mac_address] = True
+    return active
+
+
+def forget_device(mac_address):
+    """Drop a device from the detection probe caches after changing its status"""
+    with ACTIVE_DEVICE_CACHE_LOCK:
+        ACTIVE_DEVICE_CACHE.pop(mac_address, None)
+        INACTIVE_DEVICE_CACHE.pop(mac_address, None)
+
+
+def queue_coa_change(mac_address, vlan_id):
+    """Queue a CoA VLAN change to be sent once the current transaction commits"""
+    db.session.info.setdefault('pending_coa', []).append((mac_address, vlan_id))
+
+
+def delay_after_commit(task, *args):
+    """Queue a Celery task to be sent once the current transaction commits"""
+    db.session.info.setdefault('pending_tasks', []).append((task, args))
+
+
+def queue_email(task, *args, **kwargs):
+    """Queue an email for the background worker, returning False if the broker is unreachable"""
+    try:
+        task.delay(*args, **kwargs)
+        return True
+    except BrokerError as e:
+        logger.error("Could not queue %s%s: %s", task.name, args + tuple(kwargs.values()), e)
+        return False
+
+
+@event.listens_for(Session, 'after_commit')
+def send_pending_tasks(session):
+    """Send the network changes queued during a transaction once it commits"""
+    # The transaction is already committed, so a broker failure must not surface as a request error
+    # or stop the remaining tasks from being sent
+    pending = session.info.pop('pending_coa', None)
+    queued = [(send_coa_change_batch_task, (pending,))] if pending else []
+    queued.extend(session.info.pop('pending_tasks', ()))
+    for task, args in queued:
+        try:
+            task.delay(*args)
+        except BrokerError as e:
+            logger.error("Could not queue %s%s: %s", task.name, args, e)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_pending_tasks(session):
+    """Drop queued network changes when their transaction rolls back"""
+    session.info.pop('pending_coa', None)
+    session.info.pop('pending_tasks', None)
+
+
+def insert_user_with_device(user_values, device_values):
+    """
+    Create a user and attach a device to them in a single statement.
+    
+    Runs WITH new_user AS (INSERT INTO users ... RETURNING id)
+    INSERT INTO devices ... SELECT ..., new_user.id FROM new_user
+    ON CONFLICT (mac_address) DO UPDATE, saving the round-trip a flush
+    would need to learn the new user's id.
+    
+    Args:
+        user_values: User column values
+        device_values: Device column values, including mac_address (user_id is filled in)
+    """
+    new_user = pg_insert(User).values(**user_values).returning(User.id).cte('new_user')
+    
+    # INSERT ... SELECT skips Python-side column defaults, so supply the insert-only
+    # timestamps here; they are left untouched when an existing row is updated
+    now = datetime.utcnow()
+    insert_values = dict(device_values, registered_at=now, first_seen=now)
+    
+    device_columns = Device.__table__.c
+    rows = db.select(
+        *[db.literal(value, device_columns[key].type) for key, value in insert_values.items()],
+        new_user.c.id
+    )
+    stmt = pg_insert(Device).from_select(list(insert_values) + ['user_id'], rows).add_cte(new_user)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Device.mac_address],
+        set_={key: stmt.excluded[key] for key in list(device_values) + ['user_id'] if key != 'mac_address'}
+    )
+    db.session.execute(stmt)
+
+
 def get_client_ip():
-    """Get client IP address"""
-    if request.headers.get('X-Forwarded-For'):
-        return request.headers.get('X-Forwarded-For').split(',')[0].strip()
+    """Get client IP address (X-Forwarded-For is resolved by ProxyFix)"""
     return request.remote_addr
 
 
+def form_date(name, required=False):
+    """
+    Parse a YYYY-MM-DD date field from the submitted form.
+    
+    Args:
+        name: Form field name
+        required: Reject the request if the field is empty
+    
+    Returns:
+        date, or None for an empty optional field (aborts with 400 on invalid input)
+    """
+    value = request.form.get(name, '').strip()
+    if not value:
+        if required:
+            abort(400, f'{name} is required')
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        abort(400, f'{name} is not a valid date')
+
+
+# WiFi SSID broadcast on each VLAN
+SSID_MAP = MappingProxyType({
+    10: 'Blackfriars-Friars',
+    20: 'Blackfriars-Staff',
+    30: 'Blackfriars-Students',
+    40: 'Blackfriars-Guests',
+    50: 'Blackfriars-Contractors',
+    60: 'Blackfriars-Volunteers',
+    70: 'Blackfriars-IoT',
+    90: 'Blackfriars-Restricted'
+})
+
+
+# Third octet of an IPv4 address, which is the VLAN ID on this network
+IP_VLAN_RE = re.compile(r'^[0-9]+\.[0-9]+\.([0-9]+)\.[0-9]+$')
+
+
+@lru_cache(maxsize=4096)
 def detect_connection_type(ip_address):
     """
     Detect if connection is WiFi or wired based on source IP/VLAN.
     
+    Memoized per IP address: the result is an immutable tuple that depends only on the address.
+    
     Wired connections: VLAN 99 (registration VLAN for wired MAC auth)
     WiFi connections: All other VLANs (10, 20, 30, 40, 50, 60, 70, 90)
     
@@ -194,31 +502,18 @@ def detect_connection_type(ip_address):
         return ('unknown', None, None)
     
     # Extract VLAN from IP (192.168.XX.YYY)
-    parts = ip_address.split('.')
-    if len(parts) == 4:
-        try:
-            vlan_id = int(parts[2])
-            
-            # VLAN 99 = wired (registration VLAN)
-            if vlan_id == 99:
-                return ('wired', vlan_id, None)
-            
-            # Map VLAN to SSID (WiFi)
-            ssid_map = {
-                10: 'Blackfriars-Friars',
-                20: 'Blackfriars-Staff',
-                30: 'Blackfriars-Students',
-                40: 'Blackfriars-Guests',
-                50: 'Blackfriars-Contractors',
-                60: 'Blackfriars-Volunteers',
-                70: 'Blackfriars-IoT',
-                90: 'Blackfriars-Restricted'
-            }
-            
-            if vlan_id in ssid_map:
-                return ('wifi', vlan_id, ssid_map[vlan_id])
-        except ValueError:
-            pass
+    match = IP_VLAN_RE.match(ip_address)
+    if match:
+        vlan_id = int(match.group(1))
+        
+        # VLAN 99 = wired (registration VLAN)
+        if vlan_id == 99:
+            return ('wired', vlan_id, None)
+        
+        # Map VLAN to SSID (WiFi)
+        ssid = SSID_MAP.get(vlan_id)
+        if ssid is not None:
+            return ('wifi', vlan_id, ssid)
     
     return ('unknown', None, None)
 
@@ -230,7 +525,7 @@ def get_kea():
         try:
             kea_client = get_kea_client(control_socket=KEA_SOCKET)
         except Exception as e:
-            logger.error(f"Failed to initialize Kea client: {e}")
+            logger.error("Failed to initialize Kea client: %s", e)
             kea_client = None
     return kea_client
 
@@ -257,17 +552,17 @@ def manage_dns_hijack(action, ip_address):
         )
         
         if result.returncode == 0:
-            logger.info(f"DNS {action} successful for {ip_address}: {result.stdout.strip()}")
+            logger.info("DNS %s successful for %s: %s", action, ip_address, result.stdout.strip())
             return True
         else:
-            logger.error(f"DNS {action} failed for {ip_address}: {result.stderr.strip()}")
+            logger.error("DNS %s failed for %s: %s", action, ip_address, result.stderr.strip())
             return False
             
     except subprocess.TimeoutExpired:
-        logger.error(f"DNS {action} timed out for {ip_address}")
+        logger.error("DNS %s timed out for %s", action, ip_address)
         return False
     except Exception as e:
-        logger.error(f"DNS {action} error for {ip_address}: {e}")
+        logger.error("DNS %s error for %s: %s", action, ip_address, e)
         return False
 
 
@@ -277,12 +572,35 @@ def index():
     return redirect(url_for('register'))
 
 
+# Registration page URL, resolved on the first detection probe
+register_url = None
+
+
+def register_redirect():
+    """
+    Bare 302 to the registration page for captive portal detection probes.
+    
+    Devices probe these URLs constantly, so the URL is built once and the
+    response carries no HTML body.
+    """
+    global register_url
+    if register_url is None:
+        register_url = url_for('register')
+    return Response(status=302, headers={'Location': register_url, 'Cache-Control': 'no-store'})
+
+
 # Captive portal detection endpoints
 @app.route('/generate_204')
 @app.route('/gen_204')
 def android_captive_portal_detection():
-    """Android captive portal detection - return 302 to show portal"""
-    return redirect(url_for('register')), 302
+    """Android captive portal detection - 204 means no portal, 302 shows the portal"""
+    mac_address = get_client_mac()
+    
+    # Registered devices get the empty 204 Android expects, which stops the portal prompt
+    if mac_address and is_device_active(mac_address):
+        return Response(status=204)
+    
+    return register_redirect()
 
 @app.route('/hotspot-detect.html')
 def ios_captive_portal_detection():
@@ -290,14 +608,12 @@ def ios_captive_portal_detection():
     mac_address = get_client_mac()
     
     # Check if device is already registered
-    if mac_address:
-        device = Device.query.filter_by(mac_address=mac_address).first()
-        if device and device.registration_status == 'active':
-            # Device is registered - return Success to bypass portal
-            return "<HTML><BODY>Success</BODY></HTML>", 200
+    if mac_address and is_device_active(mac_address):
+        # Device is registered - return Success to bypass portal
+        return "<HTML><BODY>Success</BODY></HTML>", 200
     
     # Device not registered - redirect to portal (triggers iOS captive portal UI)
-    return redirect(url_for('register')), 302
+    return register_redirect()
 
 @app.route('/library/test/success.html')
 def ios_captive_success():
@@ -308,7 +624,14 @@ def ios_captive_success():
 @app.route('/connecttest.txt')
 def windows_captive_portal_detection():
     """Windows captive portal detection"""
-    return redirect(url_for('register')), 302
+    return register_redirect()
+
+
+# User columns register() reads or updates (skips notes, audit timestamps, etc.)
+REGISTER_USER_COLUMNS = (
+    User.status, User.begin_date, User.expiry_date,
+    User.first_name, User.last_name, User.phone_number
+)
 
 
 @app.route('/portal')
@@ -318,7 +641,7 @@ def register():
     mac_address = get_client_mac()
     ip_address = get_client_ip()
     
-    logger.info(f"Registration page accessed from IP: {ip_address}, MAC: {mac_address}")
+    logger.info("Registration page accessed from IP: %s, MAC: %s", ip_address, mac_address)
     
     if request.method == 'POST':
         email = request.form.get('email', '').strip().lower()
@@ -327,6 +650,11 @@ def register():
         phone_number = request.form.get('phone_number', '').strip()
         device_type = request.form.get('device_type', '').strip()
         
+        # Timestamps are stored in UTC (matching the model column defaults);
+        # access windows are calendar dates
+        now = datetime.utcnow()
+        today = date.today()
+        
         if not email or not first_name or not last_name or not device_type:
             flash('Please fill in all required fields', 'error')
             return render_template('register.html', detected_mac=mac_address, detected_ip=ip_address)
@@ -335,19 +663,17 @@ def register():
             flash('Could not detect your device MAC address. Please contact the administrator.', 'error')
             return render_template('register.html')
         
-        # Check if this device is already registered
-        existing_device = Device.query.filter_by(mac_address=mac_address).first()
-        if existing_device and existing_device.registration_status == 'active':
+        # Check if this device is already registered (status only - no need to load the row yet)
+        existing_status = db.session.query(Device.registration_status).filter_by(mac_address=mac_address).scalar()
+        if existing_status == 'active':
             flash('This device is already registered and active.', 'info')
             return redirect(url_for('status'))
         
         # Check if user exists in pre-authorized list
-        user = User.query.filter_by(email=email).first()
+        user = User.query.filter_by(email=email).options(load_only(*REGISTER_USER_COLUMNS)).one_or_none()
         
         if user:
             # Scenario 1: User is pre-authorized
-            today = datetime.now().date()
-            
             if user.begin_date > today:
                 flash(f'Your access begins on {user.begin_date}. Please try again after that date.', 'warning')
                 return render_template('register.html')
@@ -364,107 +690,109 @@ def register():
             if last_name:
                 user.last_name = last_name
             
-            # Create or update device record
-            device = existing_device or Device(mac_address=mac_address)
-            device.user_id = user.id
-            device.device_name = device_type
-            device.ip_address = ip_address
-            device.last_seen = datetime.now()
-            
             # Detect connection type
             connection_type, vlan_id, ssid = detect_connection_type(ip_address)
-            device.connection_type = connection_type
-            device.ssid = ssid
-            device.current_vlan = vlan_id
+            logger.info("Connection type: %s, VLAN: %s, SSID: %s", connection_type, vlan_id, ssid)
             
-            logger.info(f"Connection type: {connection_type}, VLAN: {vlan_id}, SSID: {ssid}")
+            device_values = dict(
+                mac_address=mac_address,
+                user_id=user.id,
+                device_name=device_type,
+                ip_address=ip_address,
+                last_seen=now,
+                connection_type=connection_type,
+                ssid=ssid,
+                current_vlan=vlan_id
+            )
             
             # Check if email verification is required
             email_verification_required = Setting.get_value('email_verification_required', 'false') == 'true'
             
             if email_verification_required:
                 # Generate verification token
-                device.verification_token = secrets.token_urlsafe(32)
                 timeout_minutes = int(Setting.get_value('verification_timeout_minutes', '15'))
-                device.verification_expires_at = datetime.now() + timedelta(minutes=timeout_minutes)
-                device.registration_status = 'pending'
-                
-                # Send verification email
-                verification_url = f"{os.getenv('PORTAL_URL')}/verify?token={device.verification_token}"
-                send_verification_email(email, first_name, verification_url, timeout_minutes)
-                
-                if not existing_device:
-                    db.session.add(device)
-                db.session.commit()
-                
-                flash(f'A verification email has been sent to {email}. Please click the link within {timeout_minutes} minutes to complete registration.', 'info')
+                device_values.update(
+                    verification_token=secrets.token_bytes(32),
+                    verification_expires_at=now + timedelta(minutes=timeout_minutes),
+                    registration_status='pending'
+                )
             else:
                 # Immediately activate
-                device.registration_status = 'active'
+                device_values['registration_status'] = 'active'
                 
                 # Generate unregister token for WiFi devices
                 if connection_type == 'wifi':
-                    device.unregister_token = secrets.token_urlsafe(32)
-                
-                if not existing_device:
-                    db.session.add(device)
-                db.session.commit()
-                
-                # Handle registration based on connection type
-                if connection_type == 'wifi':
-                    # WiFi: Register in Kea DHCP
-                    kea = get_kea()
-                    if kea:
-                        success = kea.register_mac(
-                            mac=mac_address,
-                            vlan=vlan_id,
-                            hostname=f"{first_name.lower()}-{last_name.lower()}-device"
-                        )
-                        
-                        if success:
-                            # Remove DNS hijacking now that device is registered
-                            manage_dns_hijack('unhijack', ip_address)
-                            
-                            # Send WiFi confirmation email with unregister link
-                            unregister_url = f"{os.getenv('PORTAL_URL')}/unregister/{device.unregister_token}"
-                            send_wifi_registration_confirmation(
-                                user_email=email,
-                                first_name=first_name,
-                                ssid=ssid,
-                                mac_address=mac_address,
-                                unregister_url=unregister_url
-                            )
-                            
-                            flash(f'Registration successful! Connecting you to {ssid}... (wait 30 seconds)', 'success')
-                            logger.info(f"WiFi device {mac_address} registered for {email} on VLAN {vlan_id}")
-                        else:
-                            # Kea registration failed, but still unhijack (device might already be registered)
-                            manage_dns_hijack('unhijack', ip_address)
-                            flash('Registration saved, but there was an issue with DHCP setup. Please contact support.', 'warning')
-                    else:
-                        flash('DHCP service unavailable. Please contact support.', 'error')
-                        
+                    device_values['unregister_token'] = secrets.token_urlsafe(32)
                 elif connection_type == 'wired':
-                    # Wired: Use RADIUS CoA
-                    vlan_map = get_vlan_map()
-                    target_vlan = vlan_map.get(user.status, vlan_map['guests'])
-                    device.current_vlan = target_vlan
-                    db.session.commit()
-                    
-                    success = send_coa_change(mac_address, target_vlan)
+                    target_vlan = user.target_vlan
+                    device_values['current_vlan'] = target_vlan
+            
+            # Create or update the device record in one statement
+            device = upsert_device(device_values)
+            
+            # Commit once, before any network side effects, so they only act on durable state
+            db.session.commit()
+            forget_device(mac_address)
+            
+            if email_verification_required:
+                # Queue verification email (sent by the background worker)
+                verification_url = VERIFY_URL(encode_token(device.verification_token))
+                if queue_email(send_verification_email_task, email, first_name, verification_url, timeout_minutes):
+                    flash(f'A verification email has been sent to {email}. Please click the link within {timeout_minutes} minutes to complete registration.', 'info')
+                else:
+                    flash('Your registration was saved, but the verification email could not be sent. Please try registering again in a few minutes.', 'warning')
+            
+            # Handle registration based on connection type
+            elif connection_type == 'wifi':
+                # WiFi: Register in Kea DHCP
+                kea = get_kea()
+                if kea:
+                    success = kea.register_mac(
+                        mac=mac_address,
+                        vlan=vlan_id,
+                        hostname=f"{first_name.lower()}-{last_name.lower()}-device"
+                    )
                     
                     if success:
                         # Remove DNS hijacking now that device is registered
                         manage_dns_hijack('unhijack', ip_address)
                         
-                        flash(f'Registration successful! You now have {user.status} access.', 'success')
-                        logger.info(f"Wired device {mac_address} registered for {email} on VLAN {target_vlan}")
+                        # Queue WiFi confirmation email with unregister link
+                        unregister_url = UNREGISTER_URL(device.unregister_token)
+                        if not queue_email(
+                            send_wifi_confirmation_task,
+                            user_email=email,
+                            first_name=first_name,
+                            ssid=ssid,
+                            mac_address=mac_address,
+                            unregister_url=unregister_url
+                        ):
+                            flash(WIFI_EMAIL_NOT_SENT, 'warning')
+                        
+                        flash(f'Registration successful! Connecting you to {ssid}... (wait 30 seconds)', 'success')
+                        logger.info("WiFi device %s registered for %s on VLAN %s", mac_address, email, vlan_id)
                     else:
-                        flash('Registration saved, but there was an issue updating your network access. Please contact support.', 'warning')
+                        # Kea registration failed, but still unhijack (device might already be registered)
+                        manage_dns_hijack('unhijack', ip_address)
+                        flash('Registration saved, but there was an issue with DHCP setup. Please contact support.', 'warning')
+                else:
+                    flash('DHCP service unavailable. Please contact support.', 'error')
+                    
+            elif connection_type == 'wired':
+                # Wired: Use RADIUS CoA
+                success = send_coa_change(mac_address, target_vlan)
+                
+                if success:
+                    # Remove DNS hijacking now that device is registered
+                    manage_dns_hijack('unhijack', ip_address)
+                    
+                    flash(f'Registration successful! You now have {user.status} access.', 'success')
+                    logger.info("Wired device %s registered for %s on VLAN %s", mac_address, email, target_vlan)
                 else:
-                    flash('Registration saved, but connection type could not be determined. Please contact support.', 'warning')
+                    flash('Registration saved, but there was an issue updating your network access. Please contact support.', 'warning')
+            else:
+                flash('Registration saved, but connection type could not be determined. Please contact support.', 'warning')
             
-            db.session.commit()
             return redirect(url_for('status'))
             
         else:
@@ -475,7 +803,7 @@ def register():
             auto_approve_vlans = get_auto_approve_vlans()
             if vlan_id in auto_approve_vlans:
                 # Auto-approve: Create user and device immediately
-                logger.info(f"Auto-approving registration for {email} on VLAN {vlan_id} (auto-approve VLAN)")
+                logger.info("Auto-approving registration for %s on VLAN %s (auto-approve VLAN)", email, vlan_id)
                 
                 # Determine user status from VLAN
                 vlan_map = get_vlan_map()
@@ -486,37 +814,37 @@ def register():
                         break
                 
                 # Create new user with status based on VLAN
-                user = User(
+                user_values = dict(
                     email=email,
                     first_name=first_name,
                     last_name=last_name,
                     phone_number=phone_number,
                     status=user_status,
-                    begin_date=datetime.now().date(),
-                    expiry_date=datetime.now().date() + timedelta(days=30)  # 30 days access
+                    begin_date=today,
+                    expiry_date=today + timedelta(days=30)  # 30 days access
                 )
-                db.session.add(user)
-                db.session.flush()  # Get user.id
                 
-                # Create device
-                device = Device(
+                # Create the device (or take over an earlier, inactive record for this MAC)
+                device_values = dict(
                     mac_address=mac_address,
-                    user_id=user.id,
                     device_name=device_type,
                     ip_address=ip_address,
                     registration_status='active',
                     current_vlan=vlan_id,
                     connection_type=connection_type,
                     ssid=ssid,
-                    last_seen=datetime.now()
+                    last_seen=now
                 )
                 
                 # Generate unregister token for WiFi
                 if connection_type == 'wifi':
-                    device.unregister_token = secrets.token_urlsafe(32)
+                    device_values['unregister_token'] = secrets.token_urlsafe(32)
+                
+                insert_user_with_device(user_values, device_values)
                 
-                db.session.add(device)
+                # Commit once, before any network side effects
                 db.session.commit()
+                forget_device(mac_address)
                 
                 # Register in Kea DHCP for WiFi
                 if connection_type == 'wifi':
@@ -532,18 +860,20 @@ def register():
                             # Remove DNS hijacking now that device is registered
                             manage_dns_hijack('unhijack', ip_address)
                             
-                            # Send WiFi confirmation email
-                            unregister_url = f"{os.getenv('PORTAL_URL')}/unregister/{device.unregister_token}"
-                            send_wifi_registration_confirmation(
+                            # Queue WiFi confirmation email
+                            unregister_url = UNREGISTER_URL(device_values['unregister_token'])
+                            if not queue_email(
+                                send_wifi_confirmation_task,
                                 user_email=email,
                                 first_name=first_name,
                                 ssid=ssid,
                                 mac_address=mac_address,
                                 unregister_url=unregister_url
-                            )
+                            ):
+                                flash(WIFI_EMAIL_NOT_SENT, 'warning')
                             
                             flash(f'Registration successful! You now have guest access. Reconnecting... (wait 30 seconds)', 'success')
-                            logger.info(f"Auto-approved WiFi device {mac_address} for {email} on VLAN {vlan_id}")
+                            logger.info("Auto-approved WiFi device %s for %s on VLAN %s", mac_address, email, vlan_id)
                         else:
                             flash('Registration saved, but there was an issue with DHCP setup. Please contact support.', 'warning')
                     else:
@@ -556,7 +886,7 @@ def register():
                         manage_dns_hijack('unhijack', ip_address)
                         
                         flash(f'Registration successful! You now have guest access.', 'success')
-                        logger.info(f"Auto-approved wired device {mac_address} for {email} on VLAN {vlan_id}")
+                        logger.info("Auto-approved wired device %s for %s on VLAN %s", mac_address, email, vlan_id)
                     else:
                         flash('Registration saved, but there was an issue updating network access. Please contact support.', 'warning')
                 
@@ -564,7 +894,7 @@ def register():
             
             else:
                 # Admin approval required
-                logger.info(f"Creating registration request for {email} on VLAN {vlan_id} (admin approval required)")
+                logger.info("Creating registration request for %s on VLAN %s (admin approval required)", email, vlan_id)
                 
                 reg_request = RegistrationRequest(
                     mac_address=mac_address,
@@ -574,19 +904,20 @@ def register():
                     phone_number=phone_number,
                     device_type=device_type,
                     ip_address=ip_address,
-                    user_agent=request.headers.get('User-Agent', ''),
+                    user_agent=request.headers.get('User-Agent', '')[:255],  # Audit only; long UAs would be TOASTed
                     approval_token=secrets.token_urlsafe(32)
                 )
                 
                 db.session.add(reg_request)
                 db.session.commit()
                 
-                # Send notification to admin
-                approval_url = f"{os.getenv('PORTAL_URL')}/admin/approve/{reg_request.approval_token}"
-                send_admin_notification(reg_request, approval_url)
+                # Queue notification to admin (sent by the background worker)
+                approval_url = APPROVAL_URL(reg_request.approval_token)
+                if not queue_email(send_admin_notification_task, reg_request.id, approval_url):
+                    flash('The administrator could not be notified by email. Please contact support so your request can be reviewed.', 'warning')
                 
                 flash('Your registration request has been submitted. An administrator will review it shortly and contact you.', 'info')
-                logger.info(f"Registration request submitted for {email} from MAC {mac_address}")
+                logger.info("Registration request submitted for %s from MAC %s", email, mac_address)
                 
                 return redirect(url_for('status'))
     
@@ -598,47 +929,42 @@ def verify():
     """Email verification endpoint"""
     token = request.args.get('token')
     
-    if not token:
+    token_bytes = decode_token(token) if token else None
+    if not token_bytes:
         flash('Invalid verification link', 'error')
         return redirect(url_for('register'))
     
-    device = Device.query.filter_by(verification_token=token).first()
+    device = Device.query.filter_by(verification_token=token_bytes).options(joinedload(Device.user)).first()
     
     if not device:
         flash('Invalid or expired verification token', 'error')
         return redirect(url_for('register'))
     
-    if device.verification_expires_at < datetime.now():
+    if device.verification_expires_at < datetime.utcnow():
         # Token expired - move to restricted VLAN
         vlan_map = get_vlan_map()
         device.registration_status = 'restricted'
         device.current_vlan = vlan_map['restricted']
+        queue_coa_change(device.mac_address, vlan_map['restricted'])
         db.session.commit()
         
-        send_coa_change(device.mac_address, vlan_map['restricted'])
-        
         flash('Verification link has expired. Your device has been placed on a restricted network. Please contact the administrator.', 'error')
         return redirect(url_for('status'))
     
     # Verification successful
     user = device.user
     if user:
-        vlan_map = get_vlan_map()
-        target_vlan = vlan_map.get(user.status, vlan_map['guests'])
+        target_vlan = user.target_vlan
         device.registration_status = 'active'
         device.current_vlan = target_vlan
         device.verification_token = None
         device.verification_expires_at = None
+        queue_coa_change(device.mac_address, target_vlan)
         db.session.commit()
+        forget_device(device.mac_address)
         
-        # Send RADIUS CoA
-        success = send_coa_change(device.mac_address, target_vlan)
-        
-        if success:
-            flash(f'Email verified! You now have {user.status} access.', 'success')
-            logger.info(f"Device {device.mac_address} verified and moved to VLAN {target_vlan}")
-        else:
-            flash('Verification successful, but there was an issue updating network access. Please contact support.', 'warning')
+        flash(f'Email verified! Your {user.status} access is being applied; if you are not online within a minute, please disconnect and reconnect.', 'success')
+        logger.info("Device %s verified, CoA to VLAN %s queued", device.mac_address, target_vlan)
     
     return redirect(url_for('status'))
 
@@ -651,7 +977,7 @@ def status():
     if not mac_address:
         return render_template('status.html', device=None)
     
-    device = Device.query.filter_by(mac_address=mac_address).first()
+    device = get_device(mac_address)
     return render_template('status.html', device=device)
 
 
@@ -668,7 +994,7 @@ def unregister(token):
         return redirect(url_for('index'))
     
     # Find device by unregister token
-    device = Device.query.filter_by(unregister_token=token).first()
+    device = Device.query.filter_by(unregister_token=token).options(joinedload(Device.user)).one_or_none()
     
     if not device:
         flash('Invalid or expired unregister token', 'error')
@@ -679,34 +1005,23 @@ def unregister(token):
     vlan_id = device.current_vlan
     user_email = device.user.email if device.user else 'Unknown'
     
-    # Remove device registration
+    # Take it off the network once the unregistration is committed
     if connection_type == 'wifi':
-        # Remove from Kea
-        kea = get_kea()
-        if kea and vlan_id:
-            success = kea.unregister_mac(mac=mac_address, vlan=vlan_id)
-            if success:
-                logger.info(f"WiFi device {mac_address} unregistered from VLAN {vlan_id}")
-            else:
-                logger.warning(f"Failed to unregister WiFi device {mac_address} from Kea")
-    
+        if vlan_id:
+            delay_after_commit(unregister_kea_mac_task, mac_address, vlan_id)
     elif connection_type == 'wired':
-        # Send RADIUS CoA to move to unregistered VLAN
-        vlan_map = get_vlan_map()
-        success = send_coa_change(mac_address, vlan_map['unregistered'])
-        if success:
-            logger.info(f"Wired device {mac_address} moved to unregistered VLAN")
-        else:
-            logger.warning(f"Failed to send CoA for wired device {mac_address}")
+        # Move to the unregistered VLAN via RADIUS CoA
+        queue_coa_change(mac_address, get_vlan_map()['unregistered'])
     
     # Update device status in database
     device.registration_status = 'unregistered'
     device.unregister_token = None  # Invalidate token
     device.user_id = None  # Remove user association
     db.session.commit()
+    forget_device(mac_address)
     
     flash(f'Device {mac_address} has been unregistered successfully. Access has been restricted.', 'success')
-    logger.info(f"Device {mac_address} (user: {user_email}) unregistered via email token")
+    logger.info("Device %s (user: %s) unregistered via email token", mac_address, user_email)
     
     return render_template('status.html', device=device, unregistered=True)
 
@@ -718,7 +1033,7 @@ def admin_login():
         username = request.form.get('username')
         password = request.form.get('password')
         
-        if username == ADMIN_USERNAME and check_password_hash(ADMIN_PASSWORD_HASH, password):
+        if username == ADMIN_USERNAME and check_password_hash(get_admin_password_hash(), password):
             user = AdminUser(username)
             login_user(user)
             return redirect(url_for('admin_dashboard'))
@@ -736,46 +1051,56 @@ def admin_logout():
     return redirect(url_for('index'))
 
 
+# User statuses configurable on the VLAN page, and the subset that can register themselves
+VLAN_STATUSES = ('friars', 'staff', 'students', 'guests', 'contractors', 'volunteers', 'iot', 'restricted', 'unregistered')
+APPROVAL_STATUSES = VLAN_STATUSES[:7]
+
+
 @app.route('/admin/vlan-config', methods=['GET', 'POST'])
 @login_required
 def admin_vlan_config():
     """VLAN configuration page"""
     if request.method == 'POST':
-        # Update VLAN mappings
-        for status in ['friars', 'staff', 'students', 'guests', 'contractors', 'volunteers', 'iot', 'restricted', 'unregistered']:
-            vlan_id = request.form.get(f'vlan_{status}')
-            if vlan_id:
-                mapping = VlanMapping.query.filter_by(status=status).first()
-                if mapping:
-                    mapping.vlan_id = int(vlan_id)
-                else:
-                    mapping = VlanMapping(status=status, vlan_id=int(vlan_id))
-                    db.session.add(mapping)
+        # Upsert all VLAN mappings in one statement
+        form_map = {
+            status: int(request.form[f'vlan_{status}'])
+            for status in VLAN_STATUSES if request.form.get(f'vlan_{status}')
+        }
+        if form_map:
+            stmt = pg_insert(VlanMapping).values(
+                [{'status': status, 'vlan_id': vlan_id} for status, vlan_id in form_map.items()]
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[VlanMapping.status],
+                set_={'vlan_id': stmt.excluded.vlan_id}
+            )
+            db.session.execute(stmt)
         
-        # Update auto-approve VLANs
-        auto_approve_vlans = []
-        for status in ['friars', 'staff', 'students', 'guests', 'contractors', 'volunteers', 'iot']:
-            if request.form.get(f'auto_approve_{status}'):
-                vlan_id = request.form.get(f'vlan_{status}')
-                if vlan_id:
-                    auto_approve_vlans.append(vlan_id)
+        # The map as it will be once this request commits
+        vlan_map = dict(get_vlan_map(), **form_map)
         
-        Setting.set_value('auto_approve_vlans', ','.join(auto_approve_vlans))
+        # Update auto-approve VLANs
+        auto_approve_vlans = [
+            str(form_map[status]) for status in APPROVAL_STATUSES
+            if request.form.get(f'auto_approve_{status}') and status in form_map
+        ]
         
         # Update admin approval VLANs (inverse of auto-approve)
-        vlan_map = get_vlan_map()
+        auto_approve_set = frozenset(auto_approve_vlans)
         admin_approval_vlans = []
-        for status in ['friars', 'staff', 'students', 'guests', 'contractors', 'volunteers', 'iot']:
+        for status in APPROVAL_STATUSES:
             vlan_id = str(vlan_map.get(status, ''))
-            if vlan_id and vlan_id not in auto_approve_vlans:
+            if vlan_id and vlan_id not in auto_approve_set:
                 admin_approval_vlans.append(vlan_id)
         
-        Setting.set_value('admin_approval_vlans', ','.join(admin_approval_vlans))
-        
-        db.session.commit()
+        # Saves both settings and the mappings above in a single commit
+        Setting.set_values({
+            'auto_approve_vlans': ','.join(auto_approve_vlans),
+            'admin_approval_vlans': ','.join(admin_approval_vlans)
+        })
         
         flash('VLAN configuration updated successfully', 'success')
-        logger.info(f"Admin updated VLAN configuration")
+        logger.info("Admin updated VLAN configuration")
         
         return redirect(url_for('admin_vlan_config'))
     
@@ -788,107 +1113,130 @@ def admin_vlan_config():
                          auto_approve_vlans=auto_approve_vlans)
 
 
-@app.route('/admin')
-@login_required
-def admin_dashboard():
-    """Admin dashboard with MAC address management, pagination, and search"""
-    # Get pagination and search parameters
-    pending_page = request.args.get('pending_page', 1, type=int)
-    pending_per_page = request.args.get('pending_per_page', 25, type=int)
+# Largest page size offered by the admin dashboard tables
+MAX_PER_PAGE = 100
+
+
+def get_pagination_args(table):
+    """Read page and per_page query args for a dashboard table, bounded to valid values"""
+    page = max(request.args.get(f'{table}_page', 1, type=int), 1)
+    per_page = min(max(request.args.get(f'{table}_per_page', 25, type=int), 1), MAX_PER_PAGE)
+    return page, per_page
+
+
+def pending_table_vars():
+    """Template variables for the pending requests table (grouped by MAC address)"""
+    pending_page, pending_per_page = get_pagination_args('pending')
     pending_search = request.args.get('pending_search', '', type=str).strip().lower()
     pending_sort = request.args.get('pending_sort', 'submitted_at')
     pending_order = request.args.get('pending_order', 'desc')
     
-    users_page = request.args.get('users_page', 1, type=int)
-    users_per_page = request.args.get('users_per_page', 25, type=int)
-    users_search = request.args.get('users_search', '', type=str).strip().lower()
-    users_sort = request.args.get('users_sort', 'email')
-    users_order = request.args.get('users_order', 'asc')
-    
-    devices_page = request.args.get('devices_page', 1, type=int)
-    devices_per_page = request.args.get('devices_per_page', 25, type=int)
-    devices_search = request.args.get('devices_search', '', type=str).strip().lower()
-    devices_sort = request.args.get('devices_sort', 'first_seen')
-    devices_order = request.args.get('devices_order', 'desc')
-    
-    # Get pending registration requests grouped by MAC address
-    all_pending = RegistrationRequest.query.filter_by(status='pending')\
-        .order_by(RegistrationRequest.submitted_at.desc()).all()
-    
-    # Group requests by MAC address
-    grouped_requests = {}
-    for req in all_pending:
-        mac = req.mac_address
-        if mac not in grouped_requests:
-            grouped_requests[mac] = {
-                'mac_address': mac,
-                'latest_request': req,  # Most recent due to ordering
-                'email': req.email,
-                'first_name': req.first_name,
-                'last_name': req.last_name,
-                'phone_number': req.phone_number,
-                'device_type': req.device_type,
-                'approval_token': req.approval_token,
-                'submitted_times': [req.submitted_at],
-                'ip_addresses': [req.ip_address] if req.ip_address else []
-            }
-        else:
-            # Add additional submission times and IPs
-            grouped_requests[mac]['submitted_times'].append(req.submitted_at)
-            if req.ip_address and req.ip_address not in grouped_requests[mac]['ip_addresses']:
-                grouped_requests[mac]['ip_addresses'].append(req.ip_address)
-    
-    # Convert to list
-    all_pending_list = list(grouped_requests.values())
+    # The most recent pending request for each MAC address supplies the row's details
+    latest = (
+        db.select(
+            RegistrationRequest.mac_address, RegistrationRequest.email,
+            RegistrationRequest.first_name, RegistrationRequest.last_name,
+            RegistrationRequest.phone_number, RegistrationRequest.device_type,
+            RegistrationRequest.approval_token, RegistrationRequest.submitted_at
+        )
+        .where(RegistrationRequest.status == 'pending')
+        .distinct(RegistrationRequest.mac_address)
+        .order_by(RegistrationRequest.mac_address, RegistrationRequest.submitted_at.desc())
+        .subquery('latest')
+    )
+    pending_query = db.select(latest)
     
     # Filter pending requests by search
     if pending_search:
-        all_pending_list = [r for r in all_pending_list if 
-                           pending_search in r['email'].lower() or
-                           pending_search in r['first_name'].lower() or
-                           pending_search in r['last_name'].lower() or
-                           pending_search in (r['phone_number'] or '').lower() or
-                           pending_search in r['mac_address'].lower() or
-                           pending_search in (r['device_type'] or '').lower()]
+        pending_query = pending_query.where(
+            db.or_(
+                latest.c.email.ilike(f'%{pending_search}%'),
+                latest.c.first_name.ilike(f'%{pending_search}%'),
+                latest.c.last_name.ilike(f'%{pending_search}%'),
+                latest.c.phone_number.ilike(f'%{pending_search}%'),
+                latest.c.mac_address.ilike(f'%{pending_search}%'),
+                latest.c.device_type.ilike(f'%{pending_search}%')
+            )
+        )
+        pending_total = db.session.scalar(db.select(func.count()).select_from(pending_query.subquery()))
+    else:
+        # Count the groups straight from the table (no DISTINCT ON sort needed)
+        pending_total = db.session.scalar(
+            db.select(func.count(RegistrationRequest.mac_address.distinct()))
+            .where(RegistrationRequest.status == 'pending')
+        )
+    
+    # Every pending submission time and IP for the row's MAC address, newest first.
+    # Correlated, so they are only aggregated for the rows on this page.
+    history = aliased(RegistrationRequest)
+    in_group = db.and_(history.mac_address == latest.c.mac_address, history.status == 'pending')
+    submitted_times = db.select(
+        func.array_agg(aggregate_order_by(history.submitted_at, history.submitted_at.desc()))
+    ).where(in_group).scalar_subquery()
+    ip_addresses = db.select(
+        func.array_agg(aggregate_order_by(history.ip_address, history.submitted_at.desc()))
+    ).where(in_group, history.ip_address.isnot(None)).scalar_subquery()
     
     # Sort pending requests
-    reverse_order = (pending_order == 'desc')
-    if pending_sort == 'submitted_at':
-        all_pending_list.sort(key=lambda x: x['submitted_times'][0], reverse=reverse_order)
-    elif pending_sort == 'name':
-        all_pending_list.sort(key=lambda x: f"{x['first_name']} {x['last_name']}".lower(), reverse=reverse_order)
-    elif pending_sort == 'email':
-        all_pending_list.sort(key=lambda x: x['email'].lower(), reverse=reverse_order)
-    elif pending_sort == 'phone':
-        all_pending_list.sort(key=lambda x: (x['phone_number'] or '').lower(), reverse=reverse_order)
-    elif pending_sort == 'device_type':
-        all_pending_list.sort(key=lambda x: (x['device_type'] or '').lower(), reverse=reverse_order)
-    elif pending_sort == 'mac_address':
-        all_pending_list.sort(key=lambda x: x['mac_address'].lower(), reverse=reverse_order)
+    sort_columns = {
+        'submitted_at': latest.c.submitted_at,
+        'name': func.lower(func.concat_ws(' ', latest.c.first_name, latest.c.last_name)),
+        'email': func.lower(latest.c.email),
+        'phone': func.lower(func.coalesce(latest.c.phone_number, '')),
+        'device_type': func.lower(func.coalesce(latest.c.device_type, '')),
+        'mac_address': func.lower(latest.c.mac_address),
+    }
+    sort_column = sort_columns.get(pending_sort, latest.c.submitted_at)
+    if pending_order == 'desc':
+        sort_column = sort_column.desc()
     
     # Paginate pending requests
-    pending_total = len(all_pending_list)
-    pending_start = (pending_page - 1) * pending_per_page
-    pending_end = pending_start + pending_per_page
-    pending_requests = all_pending_list[pending_start:pending_end]
+    rows = db.session.execute(
+        pending_query
+        .add_columns(submitted_times.label('submitted_times'), ip_addresses.label('ip_addresses'))
+        .order_by(sort_column, latest.c.submitted_at.desc())  # Ties: newest first
+        .offset((pending_page - 1) * pending_per_page)
+        .limit(pending_per_page)
+    )
+    pending_requests = [
+        dict(row._mapping, ip_addresses=list(dict.fromkeys(row.ip_addresses or ())))
+        for row in rows
+    ]
     pending_pages = (pending_total + pending_per_page - 1) // pending_per_page if pending_per_page > 0 else 0
     
+    return dict(
+        pending_requests=pending_requests,
+        pending_page=pending_page,
+        pending_per_page=pending_per_page,
+        pending_pages=pending_pages,
+        pending_total=pending_total,
+        pending_search=pending_search,
+        pending_sort=pending_sort,
+        pending_order=pending_order
+    )
+
+
+def users_table_vars():
+    """Template variables for the users table"""
+    users_page, users_per_page = get_pagination_args('users')
+    users_search = request.args.get('users_search', '', type=str).strip().lower()
+    users_sort = request.args.get('users_sort', 'email')
+    users_order = request.args.get('users_order', 'asc')
+    
     # Get all users with search filter
     users_query = User.query
     if users_search:
-        # Search in user fields OR in their devices' MAC addresses
-        users_query = users_query.outerjoin(Device).filter(
+        # Search in user fields (trigram-indexed) OR in their devices' MAC addresses.
+        # The device match is a subquery, so no join or DISTINCT is needed.
+        users_query = users_query.filter(
             db.or_(
-                User.email.ilike(f'%{users_search}%'),
-                User.first_name.ilike(f'%{users_search}%'),
-                User.last_name.ilike(f'%{users_search}%'),
-                User.phone_number.ilike(f'%{users_search}%'),
-                User.status.ilike(f'%{users_search}%'),
-                Device.mac_address.ilike(f'%{users_search}%')
+                User.search_text.like(f'%{users_search}%'),
+                User.id.in_(
+                    db.select(Device.user_id).where(Device.mac_address.ilike(f'%{users_search}%'))
+                )
             )
         )
     
-    # Apply sorting to users - must be before distinct() to work properly
     # Validate sort column exists on User model
     valid_user_sorts = ['email', 'first_name', 'last_name', 'status', 'begin_date', 'expiry_date', 'created_at', 'phone_number']
     if users_sort not in valid_user_sorts:
@@ -896,20 +1244,52 @@ def admin_dashboard():
     
     sort_column = getattr(User, users_sort)
     if users_order == 'desc':
-        users_query = users_query.order_by(sort_column.desc())
+        users_query = users_query.order_by(sort_column.desc(), User.id)
     else:
-        users_query = users_query.order_by(sort_column.asc())
-    
-    # Apply distinct after ordering
-    if users_search:
-        users_query = users_query.distinct()
-    
-    users_total = users_query.count()
-    users = users_query.offset((users_page - 1) * users_per_page).limit(users_per_page).all()
+        users_query = users_query.order_by(sort_column.asc(), User.id)
+    
+    # Only load the columns the table shows
+    users_query = users_query.options(load_only(
+        User.email, User.first_name, User.last_name, User.status,
+        User.begin_date, User.expiry_date
+    ))
+    
+    # Plain COUNT(*) over the filtered users, without the ORDER BY
+    users_total = users_query.order_by(None).with_entities(func.count(User.id)).scalar()
+    # Preload each page's devices in one extra query instead of one per user row
+    users = users_query.options(
+        selectinload(User.devices).load_only(Device.mac_address)
+    ).offset((users_page - 1) * users_per_page).limit(users_per_page).all()
     users_pages = (users_total + users_per_page - 1) // users_per_page if users_per_page > 0 else 0
     
+    return dict(
+        users=users,
+        users_page=users_page,
+        users_per_page=users_per_page,
+        users_pages=users_pages,
+        users_total=users_total,
+        users_search=users_search,
+        users_sort=users_sort,
+        users_order=users_order
+    )
+
+
+def devices_table_vars():
+    """Template variables for the devices table"""
+    devices_page, devices_per_page = get_pagination_args('devices')
+    devices_search = request.args.get('devices_search', '', type=str).strip().lower()
+    devices_sort = request.args.get('devices_sort', 'first_seen')
+    devices_order = request.args.get('devices_order', 'desc')
+    
     # Get devices with their users for display with search filter
-    devices_query = db.session.query(Device, User).join(User, Device.user_id == User.id, isouter=True)
+    devices_query = (
+        Device.query
+        .outerjoin(User, Device.user_id == User.id)
+        .options(
+            contains_eager(Device.user),  # Fill device.user from this join instead of a second one
+            raiseload('*')  # Any other relationship access would be one query per row
+        )
+    )
     
     if devices_search:
         devices_query = devices_query.filter(
@@ -945,16 +1325,14 @@ def admin_dashboard():
             devices_query = devices_query.order_by(sort_column.desc())
         else:
             devices_query = devices_query.order_by(sort_column.asc())
+    # Break ties on the primary key so rows never repeat or vanish across pages
+    devices_query = devices_query.order_by(Device.id)
     
-    devices_total = devices_query.count()
+    devices_total = devices_query.order_by(None).count()
     devices = devices_query.offset((devices_page - 1) * devices_per_page).limit(devices_per_page).all()
     devices_pages = (devices_total + devices_per_page - 1) // devices_per_page if devices_per_page > 0 else 0
     
-    # Check if this is an AJAX request
-    is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-    
-    # Common template variables
-    template_vars = dict(
+    return dict(
         devices=devices,
         devices_page=devices_page,
         devices_per_page=devices_per_page,
@@ -962,40 +1340,37 @@ def admin_dashboard():
         devices_total=devices_total,
         devices_search=devices_search,
         devices_sort=devices_sort,
-        devices_order=devices_order,
-        users=users,
-        users_page=users_page,
-        users_per_page=users_per_page,
-        users_pages=users_pages,
-        users_total=users_total,
-        users_search=users_search,
-        users_sort=users_sort,
-        users_order=users_order,
-        pending_requests=pending_requests,
-        pending_page=pending_page,
-        pending_per_page=pending_per_page,
-        pending_pages=pending_pages,
-        pending_total=pending_total,
-        pending_search=pending_search,
-        pending_sort=pending_sort,
-        pending_order=pending_order,
-        vlan_map=get_vlan_map(),
-        auto_approve_vlans=get_auto_approve_vlans(),
-        admin_approval_vlans=get_admin_approval_vlans()
+        devices_order=devices_order
     )
-    
-    # For AJAX requests, determine which table section to render
-    if is_ajax:
-        # Check which table is being sorted based on ajax_table parameter
-        ajax_table = request.args.get('ajax_table', '')
-        if ajax_table == 'pending':
-            return render_template('partials/pending_table.html', **template_vars)
-        elif ajax_table == 'users':
-            return render_template('partials/users_table.html', **template_vars)
-        elif ajax_table == 'devices':
-            return render_template('partials/devices_table.html', **template_vars)
+
+
+# Builders for each dashboard table, keyed by the ajax_table parameter
+DASHBOARD_TABLES = {
+    'pending': pending_table_vars,
+    'users': users_table_vars,
+    'devices': devices_table_vars,
+}
+
+
+@app.route('/admin')
+@login_required
+def admin_dashboard():
+    """Admin dashboard with MAC address management, pagination, and search"""
+    # AJAX sorting/paging refreshes a single table, so only query that one
+    is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    ajax_table = request.args.get('ajax_table', '')
+    if is_ajax and ajax_table in DASHBOARD_TABLES:
+        return render_template(f'partials/{ajax_table}_table.html', **DASHBOARD_TABLES[ajax_table]())
     
     # For regular requests, render the full page
+    template_vars = dict(
+        vlan_map=get_vlan_map(),
+        auto_approve_vlans=sorted(get_auto_approve_vlans()),
+        admin_approval_vlans=sorted(get_admin_approval_vlans())
+    )
+    for table_vars in DASHBOARD_TABLES.values():
+        template_vars.update(table_vars())
+    
     return render_template('admin_dashboard.html', **template_vars)
 
 
@@ -1009,11 +1384,10 @@ def admin_add_user():
         last_name = request.form.get('last_name', '').strip()
         phone_number = request.form.get('phone_number', '').strip()
         status = request.form.get('status')
-        begin_date = datetime.strptime(request.form.get('begin_date'), '%Y-%m-%d').date()
+        begin_date = form_date('begin_date', required=True)
         
         # Expiry date is optional - None means no expiration
-        expiry_date_str = request.form.get('expiry_date', '').strip()
-        expiry_date = datetime.strptime(expiry_date_str, '%Y-%m-%d').date() if expiry_date_str else None
+        expiry_date = form_date('expiry_date')
         
         notes = request.form.get('notes', '').strip()
         
@@ -1021,7 +1395,7 @@ def admin_add_user():
             flash('Email and status are required', 'error')
             return render_template('admin_add_user.html', vlan_map=get_vlan_map())
         
-        existing_user = User.query.filter_by(email=email).first()
+        existing_user = User.query.filter_by(email=email).one_or_none()
         if existing_user:
             flash('User with this email already exists', 'error')
             return render_template('admin_add_user.html', vlan_map=get_vlan_map())
@@ -1042,7 +1416,7 @@ def admin_add_user():
         db.session.commit()
         
         flash(f'User {email} added successfully', 'success')
-        logger.info(f"Admin added user: {email}")
+        logger.info("Admin added user: %s", email)
         
         return redirect(url_for('admin_dashboard'))
     
@@ -1060,29 +1434,35 @@ def admin_edit_user(user_id):
         user.last_name = request.form.get('last_name', '').strip()
         user.phone_number = request.form.get('phone_number', '').strip()
         user.status = request.form.get('status')
-        user.begin_date = datetime.strptime(request.form.get('begin_date'), '%Y-%m-%d').date()
+        user.begin_date = form_date('begin_date', required=True)
         
         # Expiry date is optional - None means no expiration
-        expiry_date_str = request.form.get('expiry_date', '').strip()
-        user.expiry_date = datetime.strptime(expiry_date_str, '%Y-%m-%d').date() if expiry_date_str else None
+        user.expiry_date = form_date('expiry_date')
         
         user.notes = request.form.get('notes', '').strip()
         
-        db.session.commit()
-        
-        # Update all active devices for this user
-        vlan_map = get_vlan_map()
-        target_vlan = vlan_map.get(user.status, vlan_map['guests'])
-        devices = Device.query.filter_by(user_id=user.id, registration_status='active').all()
-        
-        for device in devices:
-            device.current_vlan = target_vlan
-            send_coa_change(device.mac_address, target_vlan)
-        
+        # Update all active devices for this user in a single UPDATE, committed together
+        # with the user changes above. User.target_vlan maps the new status to a VLAN in SQL,
+        # and RETURNING hands back the devices that need a CoA. Devices already on the
+        # target VLAN are skipped (the usual name/notes-only edit)
+        moved = db.session.execute(
+            update(Device)
+            .where(
+                Device.user_id == User.id,
+                User.id == user.id,
+                Device.registration_status == 'active',
+                Device.current_vlan.is_distinct_from(User.target_vlan)
+            )
+            .values(current_vlan=User.target_vlan)
+            .returning(Device.mac_address, Device.current_vlan),
+            execution_options={'synchronize_session': False}
+        ).all()
+        for mac, vlan in moved:
+            queue_coa_change(mac, vlan)
         db.session.commit()
         
         flash(f'User {user.email} updated successfully', 'success')
-        logger.info(f"Admin updated user: {user.email}")
+        logger.info("Admin updated user: %s", user.email)
         
         return redirect(url_for('admin_dashboard'))
     
@@ -1112,112 +1492,110 @@ def admin_process_request(request_id):
     
     if action == 'approve':
         status = request.form.get('status')
-        begin_date = datetime.strptime(request.form.get('begin_date'), '%Y-%m-%d').date()
+        begin_date = form_date('begin_date', required=True)
         
         # Expiry date is optional - None means no expiration
-        expiry_date_str = request.form.get('expiry_date', '').strip()
-        expiry_date = datetime.strptime(expiry_date_str, '%Y-%m-%d').date() if expiry_date_str else None
+        expiry_date = form_date('expiry_date')
         
         notes = request.form.get('notes', '').strip()
         
-        # Create user
-        user = User(
-            email=reg_request.email,
-            first_name=reg_request.first_name,
-            last_name=reg_request.last_name,
-            phone_number=reg_request.phone_number,
-            status=status,
-            begin_date=begin_date,
-            expiry_date=expiry_date,
-            notes=notes,
-            created_by=current_user.username
-        )
-        db.session.add(user)
-        db.session.flush()
-        
-        # Create device
-        vlan_map = get_vlan_map()
-        target_vlan = vlan_map.get(status, vlan_map['guests'])
+        # Create user and device in one statement (no flush to learn the user's id)
+        user_values = {
+            'email': reg_request.email,
+            'first_name': reg_request.first_name,
+            'last_name': reg_request.last_name,
+            'phone_number': reg_request.phone_number,
+            'status': status,
+            'begin_date': begin_date,
+            'expiry_date': expiry_date,
+            'notes': notes,
+            'created_by': current_user.username
+        }
+        target_vlan = get_vlan_map()[status]
         
         # Detect connection type from IP address
-        connection_type, detected_vlan, ssid = detect_connection_type(reg_request.ip_address)
+        mac_address = reg_request.mac_address
+        ip_address = reg_request.ip_address
+        connection_type, detected_vlan, ssid = detect_connection_type(ip_address)
         
-        device = Device(
-            mac_address=reg_request.mac_address,
-            user_id=user.id,
-            device_name=reg_request.device_type or 'unknown',
-            ip_address=reg_request.ip_address,
-            registration_status='active',
-            current_vlan=target_vlan,
-            connection_type=connection_type,
-            ssid=ssid
-        )
-        db.session.add(device)
+        device_values = {
+            'mac_address': mac_address,
+            'device_name': reg_request.device_type or 'unknown',
+            'ip_address': ip_address,
+            'registration_status': 'active',
+            'current_vlan': target_vlan,
+            'connection_type': connection_type,
+            'ssid': ssid,
+            'verification_token': None,
+            'verification_expires_at': None
+        }
+        insert_user_with_device(user_values, device_values)
+        if connection_type != 'wifi':
+            queue_coa_change(mac_address, target_vlan)
         
-        # Mark ALL pending requests for this MAC as approved
-        all_mac_requests = RegistrationRequest.query.filter_by(
-            mac_address=reg_request.mac_address, 
+        # Mark ALL pending requests for this MAC as approved (one UPDATE, one timestamp)
+        RegistrationRequest.query.filter_by(
+            mac_address=mac_address, 
             status='pending'
-        ).all()
-        
-        for req in all_mac_requests:
-            req.status = 'approved'
-            req.processed_at = datetime.now()
-            req.processed_by = current_user.username
+        ).update({
+            RegistrationRequest.status: 'approved',
+            RegistrationRequest.processed_at: datetime.utcnow(),
+            RegistrationRequest.processed_by: current_user.username
+        })
         
         db.session.commit()
+        forget_device(mac_address)
         
         # Register in network based on connection type
-        if device.connection_type == 'wifi':
+        if connection_type == 'wifi':
             # WiFi: Register MAC in Kea DHCP
             kea = get_kea()
             if kea:
                 success = kea.register_mac(
-                    mac=device.mac_address,
+                    mac=mac_address,
                     vlan=target_vlan,
-                    hostname=f"{user.first_name.lower()}-{user.last_name.lower()}-device",
+                    hostname=f"{user_values['first_name'].lower()}-{user_values['last_name'].lower()}-device",
                     ip_address=None  # Let Kea assign from registered pool
                 )
-                if success and device.ip_address:
+                if success and ip_address:
                     # Delete the old lease to force device to get new IP from registered pool
                     try:
-                        kea.force_lease_renewal(device.mac_address, device.ip_address)
+                        kea.force_lease_renewal(mac_address, ip_address)
                     except Exception as e:
-                        logger.warning(f"Could not force lease renewal: {e}")
+                        logger.warning("Could not force lease renewal: %s", e)
                 if not success:
-                    logger.error(f"Failed to register MAC {device.mac_address} in Kea after approval")
+                    logger.error("Failed to register MAC %s in Kea after approval", mac_address)
                     # Still unhijack even if Kea registration fails (might already be registered)
-                    if device.ip_address:
-                        manage_dns_hijack('unhijack', device.ip_address)
+                    if ip_address:
+                        manage_dns_hijack('unhijack', ip_address)
                 else:
                     # Successfully registered, remove DNS hijacking
-                    if device.ip_address:
-                        manage_dns_hijack('unhijack', device.ip_address)
+                    if ip_address:
+                        manage_dns_hijack('unhijack', ip_address)
             else:
                 logger.error("Kea client unavailable for WiFi device registration")
                 # Unhijack anyway if we have an IP
-                if device.ip_address:
-                    manage_dns_hijack('unhijack', device.ip_address)
+                if ip_address:
+                    manage_dns_hijack('unhijack', ip_address)
         else:
-            # Wired: Use RADIUS CoA
-            send_coa_change(device.mac_address, target_vlan)
+            # Wired: the RADIUS CoA was queued with the commit above
             # Remove DNS hijacking for wired devices too
-            if device.ip_address:
-                manage_dns_hijack('unhijack', device.ip_address)
+            if ip_address:
+                manage_dns_hijack('unhijack', ip_address)
         
-        flash(f'Request approved and user {user.email} created', 'success')
-        logger.info(f"Admin approved registration request for {user.email}")
+        flash(f'Request approved and user {reg_request.email} created', 'success')
+        logger.info("Admin approved registration request for %s", reg_request.email)
         
     elif action == 'reject':
         reg_request.status = 'rejected'
-        reg_request.processed_at = datetime.now()
+        reg_request.processed_at = datetime.utcnow()
         reg_request.processed_by = current_user.username
         reg_request.notes = request.form.get('notes', '').strip()
         
         db.session.commit()
         
         flash('Request rejected', 'info')
-        logger.info(f"Admin rejected registration request for {reg_request.email}")
+        logger.info("Admin rejected registration request for %s", reg_request.email)
     
     return redirect(url_for('admin_dashboard'))
 
@@ -1228,16 +1606,14 @@ def admin_disconnect_device(device_id):
     """Disconnect a device from the network"""
     device = Device.query.get_or_404(device_id)
     
-    success = send_coa_disconnect(device.mac_address)
-    
-    if success:
-        vlan_map = get_vlan_map()
-        device.registration_status = 'disconnected'
-        device.current_vlan = vlan_map['unregistered']
-        db.session.commit()
-        flash(f'Device {device.mac_address} disconnected', 'success')
-    else:
+    # The worker records the device as disconnected once the NAS acknowledges
+    try:
+        disconnect_device_task.delay(device.id)
+    except BrokerError as e:
+        logger.error("Could not queue disconnect for device %s (%s): %s", device.id, device.mac_address, e)
         flash('Failed to disconnect device', 'error')
+    else:
+        flash(f'Device {device.mac_address} disconnect requested', 'success')
     
     return redirect(url_for('admin_dashboard'))
 
@@ -1251,18 +1627,18 @@ def admin_block_device(device_id):
     vlan_map = get_vlan_map()
     device.registration_status = 'blocked'
     device.current_vlan = vlan_map['restricted']  # Move to restricted VLAN
-    db.session.commit()
     
-    # Disconnect from network if WiFi
+    # Take it off the network once the block is committed
     if device.connection_type == 'wifi':
-        kea = get_kea()
-        if kea:
-            kea.unregister_mac(device.mac_address, device.current_vlan)
+        delay_after_commit(unregister_kea_mac_task, device.mac_address, device.current_vlan)
     elif device.connection_type == 'wired':
-        send_coa_disconnect(device.mac_address)
+        delay_after_commit(send_coa_disconnect_task, device.mac_address)
+    
+    db.session.commit()
+    forget_device(device.mac_address)
     
     flash(f'Device {device.mac_address} has been blocked', 'success')
-    logger.info(f"Admin blocked device {device.mac_address}")
+    logger.info("Admin blocked device %s", device.mac_address)
     
     return redirect(url_for('admin_dashboard'))
 
@@ -1271,30 +1647,28 @@ def admin_block_device(device_id):
 @login_required
 def admin_unblock_device(device_id):
     """Unblock a device"""
-    device = Device.query.get_or_404(device_id)
-    user = User.query.get(device.user_id)
+    device = Device.query.options(joinedload(Device.user)).get_or_404(device_id)
+    user = device.user
     
     device.registration_status = 'active'
     
     # Determine target VLAN based on user status
-    vlan_map = get_vlan_map()
     if user:
-        device.current_vlan = vlan_map.get(user.status, vlan_map['guests'])
+        device.current_vlan = user.target_vlan
     else:
-        device.current_vlan = vlan_map['guests']
-    
-    db.session.commit()
+        device.current_vlan = get_vlan_map()['guests']
     
-    # Re-register in network
+    # Re-register in network once the unblock is committed
     if device.connection_type == 'wifi':
-        kea = get_kea()
-        if kea:
-            kea.register_mac(device.mac_address, device.current_vlan)
+        delay_after_commit(register_kea_mac_task, device.mac_address, device.current_vlan)
     elif device.connection_type == 'wired':
-        send_coa_change(device.mac_address, device.current_vlan)
+        queue_coa_change(device.mac_address, device.current_vlan)
+    
+    db.session.commit()
+    forget_device(device.mac_address)
     
     flash(f'Device {device.mac_address} has been unblocked', 'success')
-    logger.info(f"Admin unblocked device {device.mac_address}")
+    logger.info("Admin unblocked device %s", device.mac_address)
     
     return redirect(url_for('admin_dashboard'))
 
@@ -1306,34 +1680,52 @@ def admin_delete_device(device_id):
     device = Device.query.get_or_404(device_id)
     mac_address = device.mac_address
     
-    # Unregister from network first
+    # Unregister from network once the deletion is committed
     if device.connection_type == 'wifi':
-        kea = get_kea()
-        if kea:
-            kea.unregister_mac(device.mac_address, device.current_vlan)
+        delay_after_commit(unregister_kea_mac_task, device.mac_address, device.current_vlan)
     elif device.connection_type == 'wired':
-        send_coa_disconnect(device.mac_address)
+        delay_after_commit(send_coa_disconnect_task, device.mac_address)
     
     db.session.delete(device)
     db.session.commit()
+    forget_device(mac_address)
     
     flash(f'Device {mac_address} has been deleted', 'success')
-    logger.info(f"Admin deleted device {mac_address}")
+    logger.info("Admin deleted device %s", mac_address)
     
     return redirect(url_for('admin_dashboard'))
 
 
+# Bursts of health probes share one database ping per second
+HEALTH_CACHE = TTLCache(maxsize=1, ttl=1)
+HEALTH_SQL = text('SELECT 1')
+
+
+@cached(cache=HEALTH_CACHE, lock=threading.Lock())
+def ping_database():
+    """Run SELECT 1 on a short-lived autocommit connection, independent of any request session"""
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        return conn.scalar(HEALTH_SQL)
+
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
     try:
-        # Check database connection
-        db.session.execute('SELECT 1')
+        ping_database()
+        
+        # Report pool usage so connection-wait problems show up in the probe
+        pool = db.engine.pool
+        if hasattr(pool, 'checkedout'):
+            return jsonify({
+                'status': 'healthy',
+                'pool': {'size': pool.size(), 'checked_in': pool.checkedin(), 'checked_out': pool.checkedout()}
+            }), 200
         return jsonify({'status': 'healthy'}), 200
     except Exception as e:
-        logger.error(f"Health check failed: {e}")
+        logger.error("Health check failed: %s", e)
         return jsonify({'status': 'unhealthy', 'error': str(e)}), 500
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    app.run(host='0.0.0.0', port=8080, debug=os.getenv('FLASK_DEBUG') == '1')
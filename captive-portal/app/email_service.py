@@ -5,8 +5,10 @@ Email service for sending notifications via Microsoft Graph API
 import os
 import logging
 import json
+from functools import lru_cache
 import msal
 import requests
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +24,26 @@ GRAPH_AUTHORITY = f'https://login.microsoftonline.com/{GRAPH_TENANT_ID}'
 GRAPH_SCOPE = ['https://graph.microsoft.com/.default']
 GRAPH_ENDPOINT = 'https://graph.microsoft.com/v1.0'
 
+# HTML email bodies (templates/emails), parsed once and cached by the environment.
+# Autoescaped, since names and emails in them come from the registration form.
+EMAIL_TEMPLATES = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates', 'emails')),
+    autoescape=select_autoescape(['html'])
+)
+
+# Keep-alive connection pool to Graph, reused by every email this process sends
+graph_session = requests.Session()
+
+
+@lru_cache(maxsize=1)
+def get_graph_client():
+    """Return the MSAL client, created once so its token cache is reused between emails"""
+    return msal.ConfidentialClientApplication(
+        GRAPH_CLIENT_ID,
+        authority=GRAPH_AUTHORITY,
+        client_credential=GRAPH_CLIENT_SECRET
+    )
+
 
 def get_graph_access_token():
     """
@@ -35,22 +57,17 @@ def get_graph_access_token():
         return None
     
     try:
-        app = msal.ConfidentialClientApplication(
-            GRAPH_CLIENT_ID,
-            authority=GRAPH_AUTHORITY,
-            client_credential=GRAPH_CLIENT_SECRET
-        )
-        
-        result = app.acquire_token_for_client(scopes=GRAPH_SCOPE)
+        # Served from MSAL's token cache until the token is close to expiry
+        result = get_graph_client().acquire_token_for_client(scopes=GRAPH_SCOPE)
         
         if 'access_token' in result:
             return result['access_token']
         else:
-            logger.error(f"Failed to acquire token: {result.get('error_description')}")
+            logger.error("Failed to acquire token: %s", result.get('error_description'))
             return None
             
     except Exception as e:
-        logger.error(f"Error getting Graph access token: {e}")
+        logger.error("Error getting Graph access token: %s", e)
         return None
 
 
@@ -106,7 +123,7 @@ def send_email(to_email, subject, html_body, text_body=None):
         # Use sendMail endpoint
         send_url = f"{GRAPH_ENDPOINT}/users/{GRAPH_FROM_EMAIL}/sendMail"
         
-        response = requests.post(
+        response = graph_session.post(
             send_url,
             headers=headers,
             data=json.dumps(email_message),
@@ -114,14 +131,14 @@ def send_email(to_email, subject, html_body, text_body=None):
         )
         
         if response.status_code == 202:  # Accepted
-            logger.info(f"Email sent to {to_email}: {subject}")
+            logger.info("Email sent to %s: %s", to_email, subject)
             return True
         else:
-            logger.error(f"Failed to send email: HTTP {response.status_code} - {response.text}")
+            logger.error("Failed to send email: HTTP %s - %s", response.status_code, response.text)
             return False
         
     except Exception as e:
-        logger.error(f"Failed to send email to {to_email}: {e}")
+        logger.error("Failed to send email to %s: %s", to_email, e)
         return False
 
 
@@ -137,38 +154,9 @@ def send_verification_email(to_email, first_name, verification_url, timeout_minu
     """
     subject = "Verify Your Network Access"
     
-    html_body = f"""
-    <html>
-    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-        <h2>Welcome, {first_name}!</h2>
-        
-        <p>Thank you for registering your device on our network.</p>
-        
-        <p>To complete your registration and gain full network access, please click the link below within the next {timeout_minutes} minutes:</p>
-        
-        <p style="margin: 20px 0;">
-            <a href="{verification_url}" 
-               style="background-color: #007bff; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; display: inline-block;">
-                Verify My Email
-            </a>
-        </p>
-        
-        <p>Or copy and paste this link into your browser:</p>
-        <p style="background-color: #f5f5f5; padding: 10px; border-left: 3px solid #007bff; word-break: break-all;">
-            {verification_url}
-        </p>
-        
-        <p><strong>Important:</strong> If you don't verify within {timeout_minutes} minutes, your device will be placed on a restricted network and you'll need to contact the administrator.</p>
-        
-        <p>If you didn't request this, please ignore this email or contact the network administrator.</p>
-        
-        <hr style="margin: 30px 0; border: none; border-top: 1px solid #ddd;">
-        <p style="color: #666; font-size: 12px;">
-            This is an automated message from the Network Access Portal.
-        </p>
-    </body>
-    </html>
-    """
+    html_body = EMAIL_TEMPLATES.get_template('verification.html').render(
+        first_name=first_name, verification_url=verification_url, timeout_minutes=timeout_minutes
+    )
     
     text_body = f"""
     Welcome, {first_name}!
@@ -201,61 +189,9 @@ def send_admin_notification(registration_request, approval_url):
     
     subject = f"New Network Access Request: {registration_request.email}"
     
-    html_body = f"""
-    <html>
-    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-        <h2>New Network Access Request</h2>
-        
-        <p>A new user has requested network access. Please review the details below:</p>
-        
-        <table style="border-collapse: collapse; margin: 20px 0;">
-            <tr>
-                <td style="padding: 8px; font-weight: bold; background-color: #f5f5f5;">Name:</td>
-                <td style="padding: 8px;">{registration_request.full_name}</td>
-            </tr>
-            <tr>
-                <td style="padding: 8px; font-weight: bold; background-color: #f5f5f5;">Email:</td>
-                <td style="padding: 8px;">{registration_request.email}</td>
-            </tr>
-            <tr>
-                <td style="padding: 8px; font-weight: bold; background-color: #f5f5f5;">Phone:</td>
-                <td style="padding: 8px;">{registration_request.phone_number or 'Not provided'}</td>
-            </tr>
-            <tr>
-                <td style="padding: 8px; font-weight: bold; background-color: #f5f5f5;">MAC Address:</td>
-                <td style="padding: 8px; font-family: monospace;">{registration_request.mac_address}</td>
-            </tr>
-            <tr>
-                <td style="padding: 8px; font-weight: bold; background-color: #f5f5f5;">IP Address:</td>
-                <td style="padding: 8px;">{registration_request.ip_address}</td>
-            </tr>
-            <tr>
-                <td style="padding: 8px; font-weight: bold; background-color: #f5f5f5;">Submitted:</td>
-                <td style="padding: 8px;">{registration_request.submitted_at.strftime('%Y-%m-%d %H:%M:%S')}</td>
-            </tr>
-        </table>
-        
-        <p style="margin: 20px 0;">
-            <a href="{approval_url}" 
-               style="background-color: #28a745; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; display: inline-block;">
-                Review and Approve
-            </a>
-        </p>
-        
-        <p>Or copy and paste this link into your browser:</p>
-        <p style="background-color: #f5f5f5; padding: 10px; border-left: 3px solid #28a745; word-break: break-all;">
-            {approval_url}
-        </p>
-        
-        <p><strong>Action Required:</strong> Please contact the user to verify their identity before approving access.</p>
-        
-        <hr style="margin: 30px 0; border: none; border-top: 1px solid #ddd;">
-        <p style="color: #666; font-size: 12px;">
-            This is an automated message from the Network Access Portal.
-        </p>
-    </body>
-    </html>
-    """
+    html_body = EMAIL_TEMPLATES.get_template('admin_notification.html').render(
+        registration_request=registration_request, approval_url=approval_url
+    )
     
     text_body = f"""
     New Network Access Request
@@ -289,26 +225,7 @@ def send_approval_notification(user_email, first_name, status):
     """
     subject = "Network Access Approved"
     
-    html_body = f"""
-    <html>
-    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-        <h2>Welcome, {first_name}!</h2>
-        
-        <p>Your network access request has been approved.</p>
-        
-        <p><strong>Access Level:</strong> {status.title()}</p>
-        
-        <p>Your device should now have full network access. If you experience any issues, please contact the network administrator.</p>
-        
-        <p>Thank you!</p>
-        
-        <hr style="margin: 30px 0; border: none; border-top: 1px solid #ddd;">
-        <p style="color: #666; font-size: 12px;">
-            This is an automated message from the Network Access Portal.
-        </p>
-    </body>
-    </html>
-    """
+    html_body = EMAIL_TEMPLATES.get_template('approval.html').render(first_name=first_name, status=status)
     
     text_body = f"""
     Welcome, {first_name}!
@@ -338,58 +255,9 @@ def send_wifi_registration_confirmation(user_email, first_name, ssid, mac_addres
     """
     subject = f"WiFi Registration Confirmed - {ssid}"
     
-    html_body = f"""
-    <html>
-    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-        <div style="max-width: 600px; margin: 0 auto;">
-            <div style="background: linear-gradient(135deg, #1a2b1a 0%, #263326 100%); color: white; padding: 30px; text-align: center;">
-                <h1 style="margin: 0; font-size: 28px;">Welcome to {ssid}!</h1>
-            </div>
-            
-            <div style="padding: 30px; background-color: #f9f9f9;">
-                <h2 style="color: #263326; margin-top: 0;">Hi {first_name},</h2>
-                
-                <p style="font-size: 16px;">Your device has been successfully registered on our WiFi network.</p>
-                
-                <div style="background-color: white; border-left: 4px solid #263326; padding: 15px; margin: 20px 0;">
-                    <p style="margin: 0;"><strong>Network:</strong> {ssid}</p>
-                    <p style="margin: 10px 0 0; font-family: monospace; font-size: 14px;"><strong>Device:</strong> {mac_address}</p>
-                </div>
-                
-                <div style="background-color: #e8f5e9; border-left: 4px solid #4caf50; padding: 15px; margin: 20px 0;">
-                    <p style="margin: 0; color: #2e7d32;"><strong>✓ Your connection is now active</strong></p>
-                    <p style="margin: 10px 0 0; font-size: 14px;">Please wait up to 30 seconds for your device to renew its connection and gain full internet access.</p>
-                </div>
-                
-                <h3 style="color: #263326; margin-top: 30px;">Need to Remove This Device?</h3>
-                
-                <p>If you no longer use this device or need to unregister it for any reason, you can do so at any time:</p>
-                
-                <p style="text-align: center; margin: 25px 0;">
-                    <a href="{unregister_url}" 
-                       style="background-color: #d32f2f; color: white; padding: 12px 30px; text-decoration: none; border-radius: 5px; display: inline-block; font-weight: bold;">
-                        Unregister This Device
-                    </a>
-                </p>
-                
-                <p style="font-size: 13px; color: #666; border-top: 1px solid #ddd; padding-top: 15px; margin-top: 30px;">
-                    <strong>Important:</strong> Clicking the unregister link will immediately revoke network access for this device. 
-                    This prevents someone else from impersonating your device using its MAC address.
-                </p>
-                
-                <p style="font-size: 13px; color: #666;">
-                    If you experience any connection issues, please contact the network administrator.
-                </p>
-            </div>
-            
-            <div style="background-color: #263326; color: #999; padding: 20px; text-align: center; font-size: 12px;">
-                <p style="margin: 0;">This is an automated message from Blackfriars Network Access Portal</p>
-                <p style="margin: 10px 0 0;">If you didn't register this device, please contact us immediately</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
+    html_body = EMAIL_TEMPLATES.get_template('wifi_confirmation.html').render(
+        first_name=first_name, ssid=ssid, mac_address=mac_address, unregister_url=unregister_url
+    )
     
     text_body = f"""
     Welcome to {ssid}!
@@ -0,0 +1,19 @@
+"""
+Gunicorn configuration for Captive Portal
+Uses gevent workers so requests waiting on I/O (database, Kea socket,
+RADIUS, email) yield to other requests instead of blocking the worker
+"""
+
+import os
+
+bind = '0.0.0.0:8080'
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+worker_class = 'gevent'
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = 120
+
+
+def post_fork(server, worker):
+    """Make psycopg2 cooperative - it is a C extension the gevent monkey patch cannot reach"""
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
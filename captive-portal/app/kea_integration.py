@@ -12,6 +12,7 @@ Supports both control socket and HTTP API communication.
 import json
 import socket
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List
@@ -35,6 +36,12 @@ class KeaIntegration:
         
         if not control_socket and not api_url:
             raise ValueError("Either control_socket or api_url must be provided")
+        
+        # Keep-alive connections to the HTTP API, reused across commands
+        self.session = None
+        if api_url:
+            self.session = requests.Session()
+            self.session.mount(api_url, HTTPAdapter(pool_connections=1, pool_maxsize=20))
     
     def _send_command_socket(self, command: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -65,7 +72,7 @@ class KeaIntegration:
             return json.loads(response.decode())
         
         except Exception as e:
-            logger.error(f"Error communicating with Kea socket: {e}")
+            logger.error("Error communicating with Kea socket: %s", e)
             raise
     
     def _send_command_http(self, command: Dict[str, Any]) -> Dict[str, Any]:
@@ -79,7 +86,7 @@ class KeaIntegration:
             Response dictionary from Kea
         """
         try:
-            response = requests.post(
+            response = self.session.post(
                 self.api_url,
                 json=command,
                 headers={'Content-Type': 'application/json'},
@@ -89,7 +96,7 @@ class KeaIntegration:
             return response.json()
         
         except Exception as e:
-            logger.error(f"Error communicating with Kea HTTP API: {e}")
+            logger.error("Error communicating with Kea HTTP API: %s", e)
             raise
     
     def _send_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
@@ -160,12 +167,12 @@ class KeaIntegration:
                 if len(ip_parts) == 4:
                     last_octet = int(ip_parts[3])
                     if not (5 <= last_octet <= 127):
-                        logger.error(f"IP {ip_address} not in registered pool range (.5-.127)")
+                        logger.error("IP %s not in registered pool range (.5-.127)", ip_address)
                         return False
                 reservation["ip-address"] = ip_address
-                logger.info(f"Assigning specific IP {ip_address} to MAC {mac}")
+                logger.info("Assigning specific IP %s to MAC %s", ip_address, mac)
             else:
-                logger.info(f"Creating reservation for MAC {mac} without specific IP - Kea will assign from pool")
+                logger.info("Creating reservation for MAC %s without specific IP - Kea will assign from pool", mac)
             
             # Build command
             command = {
@@ -180,20 +187,20 @@ class KeaIntegration:
             
             # Check response
             if response.get("result") == 0:
-                logger.info(f"Successfully registered MAC {mac} in VLAN {vlan} (registered pool)")
+                logger.info("Successfully registered MAC %s in VLAN %s (registered pool)", mac, vlan)
                 return True
             else:
                 error_text = response.get('text', '')
                 # Treat duplicate entry as success - reservation already exists
                 if 'duplicate' in error_text.lower() or 'already exists' in error_text.lower():
-                    logger.info(f"MAC {mac} already registered in VLAN {vlan} (duplicate is OK)")
+                    logger.info("MAC %s already registered in VLAN %s (duplicate is OK)", mac, vlan)
                     return True
                 else:
-                    logger.error(f"Failed to register MAC {mac}: {error_text}")
+                    logger.error("Failed to register MAC %s: %s", mac, error_text)
                     return False
         
         except Exception as e:
-            logger.error(f"Error registering MAC {mac}: {e}")
+            logger.error("Error registering MAC %s: %s", mac, e)
             return False
     
     def unregister_mac(self, mac: str, vlan: int) -> bool:
@@ -231,14 +238,14 @@ class KeaIntegration:
             
             # Check response (0 = success, 3 = not found is also ok)
             if response.get("result") in [0, 3]:
-                logger.info(f"Successfully unregistered MAC {mac} from VLAN {vlan}")
+                logger.info("Successfully unregistered MAC %s from VLAN %s", mac, vlan)
                 return True
             else:
-                logger.error(f"Failed to unregister MAC {mac}: {response.get('text')}")
+                logger.error("Failed to unregister MAC %s: %s", mac, response.get('text'))
                 return False
         
         except Exception as e:
-            logger.error(f"Error unregistering MAC {mac}: {e}")
+            logger.error("Error unregistering MAC %s: %s", mac, e)
             return False
     
     def get_reservation(self, mac: str, vlan: int) -> Optional[Dict[str, Any]]:
@@ -274,7 +281,7 @@ class KeaIntegration:
                 return None
         
         except Exception as e:
-            logger.error(f"Error getting reservation for MAC {mac}: {e}")
+            logger.error("Error getting reservation for MAC %s: %s", mac, e)
             return None
     
     def get_all_reservations(self, vlan: int) -> List[Dict[str, Any]]:
@@ -306,7 +313,7 @@ class KeaIntegration:
                 return []
         
         except Exception as e:
-            logger.error(f"Error getting all reservations for VLAN {vlan}: {e}")
+            logger.error("Error getting all reservations for VLAN %s: %s", vlan, e)
             return []
     
     def _find_available_registered_ip(self, subnet_id: int) -> Optional[str]:
@@ -355,7 +362,7 @@ class KeaIntegration:
             return None
             
         except Exception as e:
-            logger.error(f"Error finding available IP: {e}")
+            logger.error("Error finding available IP: %s", e)
             return None
     
     def get_lease(self, ip: str) -> Optional[Dict[str, Any]]:
@@ -385,7 +392,7 @@ class KeaIntegration:
                 return None
         
         except Exception as e:
-            logger.error(f"Error getting lease for IP {ip}: {e}")
+            logger.error("Error getting lease for IP %s: %s", ip, e)
             return None
     
     def get_lease_by_mac(self, mac: str) -> Optional[Dict[str, Any]]:
@@ -418,7 +425,7 @@ class KeaIntegration:
                 return None
         
         except Exception as e:
-            logger.error(f"Error getting lease for MAC {mac}: {e}")
+            logger.error("Error getting lease for MAC %s: %s", mac, e)
             return None
     
     def force_lease_renewal(self, mac: str, ip_address: Optional[str] = None) -> bool:
@@ -437,12 +444,12 @@ class KeaIntegration:
             if not ip_address:
                 lease = self.get_lease_by_mac(mac)
                 if not lease:
-                    logger.warning(f"No active lease found for MAC {mac}")
+                    logger.warning("No active lease found for MAC %s", mac)
                     return False
                 ip_address = lease.get("ip-address")
             
             if not ip_address:
-                logger.error(f"No IP address available for MAC {mac}")
+                logger.error("No IP address available for MAC %s", mac)
                 return False
             
             # Delete the lease by IP (with subnet-id for memfile backend)
@@ -458,19 +465,19 @@ class KeaIntegration:
                 }
             }
             
-            logger.info(f"Sending lease4-del command: {command}")
+            logger.info("Sending lease4-del command: %s", command)
             response = self._send_command(command)
-            logger.info(f"lease4-del response: {response}")
+            logger.info("lease4-del response: %s", response)
             
             if response.get("result") == 0:
-                logger.info(f"Successfully deleted lease for MAC {mac}, IP {ip_address}")
+                logger.info("Successfully deleted lease for MAC %s, IP %s", mac, ip_address)
                 return True
             else:
-                logger.error(f"Failed to delete lease: {response.get('text')}")
+                logger.error("Failed to delete lease: %s", response.get('text'))
                 return False
         
         except Exception as e:
-            logger.error(f"Error forcing lease renewal for MAC {mac}: {e}")
+            logger.error("Error forcing lease renewal for MAC %s: %s", mac, e)
             return False
     
     def get_stats(self) -> Dict[str, Any]:
@@ -494,7 +501,7 @@ class KeaIntegration:
                 return {}
         
         except Exception as e:
-            logger.error(f"Error getting Kea stats: {e}")
+            logger.error("Error getting Kea stats: %s", e)
             return {}
 
 
@@ -2,12 +2,89 @@
 Database models for Captive Portal
 """
 
+import os
+from threading import Lock
+from types import MappingProxyType
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.hybrid import hybrid_property
+from cachetools import TTLCache, cached
+from datetime import date, datetime, timedelta
 
 db = SQLAlchemy()
 
 
+class VlanMap(dict):
+    """status -> VLAN mapping where unknown user statuses fall back to the guests VLAN"""
+    __slots__ = ()
+    
+    def __missing__(self, status):
+        # Never put blocked or unregistered devices on the guests VLAN by accident
+        if status in ('guests', 'restricted', 'unregistered'):
+            raise KeyError(status)
+        return self['guests']
+
+
+# Default VLAN for each user status, used when the vlan_mappings table is empty.
+# Built once at import from environment variables.
+DEFAULT_VLAN_MAP = MappingProxyType(VlanMap({
+    'friars': int(os.getenv('VLAN_FRIARS', 10)),
+    'staff': int(os.getenv('VLAN_STAFF', 20)),
+    'students': int(os.getenv('VLAN_STUDENTS', 30)),
+    'guests': int(os.getenv('VLAN_GUESTS', 40)),
+    'contractors': int(os.getenv('VLAN_CONTRACTORS', 50)),
+    'volunteers': int(os.getenv('VLAN_VOLUNTEERS', 60)),
+    'iot': int(os.getenv('VLAN_IOT', 70)),
+    'restricted': int(os.getenv('VLAN_RESTRICTED', 90)),
+    'unregistered': int(os.getenv('VLAN_UNREGISTERED', 99)),
+}))
+
+# Settings and VLAN mappings only change from the admin config page, so cache them
+# per process. Writers touch SETTINGS_VERSION_FILE, and every worker sharing the file
+# drops its caches when the file's mtime changes; the TTL bounds staleness otherwise.
+_settings_cache = TTLCache(maxsize=1, ttl=300)
+_settings_cache_lock = Lock()
+_vlan_map_cache = TTLCache(maxsize=1, ttl=300)
+_vlan_map_cache_lock = Lock()
+_settings_version = None
+SETTINGS_VERSION_FILE = os.getenv('SETTINGS_VERSION_FILE', '/tmp/captive-portal-settings.version')
+
+
+def settings_version():
+    """Return the mtime of the settings version file, or None if it does not exist"""
+    try:
+        return os.stat(SETTINGS_VERSION_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def check_settings_version():
+    """Drop cached settings and VLAN mappings if another worker has changed them"""
+    global _settings_version
+    version = settings_version()
+    if version != _settings_version:
+        invalidate_config()
+        _settings_version = version
+
+
+def invalidate_config():
+    """Drop cached settings and VLAN mappings so the next lookup reads the database"""
+    with _settings_cache_lock:
+        _settings_cache.clear()
+    with _vlan_map_cache_lock:
+        _vlan_map_cache.clear()
+
+
+def touch_settings_version():
+    """Tell other worker processes to drop their cached settings and VLAN mappings"""
+    try:
+        with open(SETTINGS_VERSION_FILE, 'a'):
+            os.utime(SETTINGS_VERSION_FILE)
+    except OSError:
+        pass
+
+
 class User(db.Model):
     """Authorized users with network access"""
     __tablename__ = 'users'
@@ -25,8 +102,8 @@ class User(db.Model):
     created_by = db.Column(db.String(100), default='admin')
     notes = db.Column(db.Text)
     
-    # Relationships
-    devices = db.relationship('Device', backref='user', lazy=True, cascade='all, delete-orphan')
+    # Relationships - most user lookups never touch devices, so load them on demand
+    devices = db.relationship('Device', back_populates='user', lazy='select', cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<User {self.email}>'
@@ -37,16 +114,55 @@ class User(db.Model):
     
     @property
     def is_active(self):
-        today = datetime.now().date()
+        today = date.today()
         # No expiry date means permanent access
         if self.expiry_date is None:
             return self.begin_date <= today
         return self.begin_date <= today <= self.expiry_date
+    
+    @hybrid_property
+    def target_vlan(self):
+        """VLAN this user's devices belong on (guests VLAN for unknown statuses)"""
+        return VlanMapping.get_map()[self.status]
+    
+    @target_vlan.expression
+    def target_vlan(cls):
+        # CASE over the cached map, so bulk statements resolve each row's VLAN server-side
+        vlan_map = VlanMapping.get_map()
+        return db.case(dict(vlan_map), value=cls.status, else_=vlan_map['guests'])
+    
+    @hybrid_property
+    def search_text(self):
+        """Lowercased text the admin users search matches against"""
+        return ' '.join((self.email, self.first_name or '', self.last_name or '',
+                         self.phone_number or '', self.status)).lower()
+    
+    @search_text.expression
+    def search_text(cls):
+        # Built from || and coalesce (not concat_ws) so it is immutable and can be indexed
+        return db.func.lower(
+            cls.email + ' ' + db.func.coalesce(cls.first_name, '') + ' ' + db.func.coalesce(cls.last_name, '')
+            + ' ' + db.func.coalesce(cls.phone_number, '') + ' ' + cls.status
+        )
+
+
+# Trigram index so the admin users search (LIKE '%term%') can avoid a sequential scan
+db.Index('ix_users_search_trgm', User.search_text.label('search_text'),
+         postgresql_using='gin', postgresql_ops={'search_text': 'gin_trgm_ops'})
+event.listen(User.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
 
 
 class Device(db.Model):
     """Registered network devices"""
     __tablename__ = 'devices'
+    __table_args__ = (
+        # Only pending devices carry a token, so keep the index small
+        db.Index('ix_device_token_active', 'verification_token',
+                 postgresql_where=db.text('verification_token IS NOT NULL')),
+        # A user's active devices (admin edit); also covers plain user_id lookups
+        db.Index('ix_device_user_status', 'user_id', 'registration_status'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     mac_address = db.Column(db.String(17), unique=True, nullable=False, index=True)
@@ -54,7 +170,7 @@ class Device(db.Model):
     device_name = db.Column(db.String(100))
     current_vlan = db.Column(db.Integer)
     registration_status = db.Column(db.String(50), default='pending', index=True)
-    verification_token = db.Column(db.String(255))
+    verification_token = db.Column(db.LargeBinary(32))  # Raw bytes; base64url-encoded in the verify link
     verification_expires_at = db.Column(db.DateTime)
     registered_at = db.Column(db.DateTime, default=datetime.utcnow)
     first_seen = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # For pool assignment
@@ -66,6 +182,9 @@ class Device(db.Model):
     ssid = db.Column(db.String(100))  # WiFi SSID (e.g., 'Blackfriars-Guests')
     unregister_token = db.Column(db.String(255), unique=True, index=True)  # For email unregister link
     
+    # Relationships (lazy by default; callers that read the owner opt in to eager loading)
+    user = db.relationship('User', back_populates='devices', lazy='select')
+    
     def __repr__(self):
         return f'<Device {self.mac_address}>'
     
@@ -91,6 +210,14 @@ class Device(db.Model):
 class RegistrationRequest(db.Model):
     """Pending registration requests from unknown users"""
     __tablename__ = 'registration_requests'
+    __table_args__ = (
+        # Latest pending request per MAC (admin dashboard) and bulk approval by MAC.
+        # Covers the dashboard's columns so its pending list is an index-only scan.
+        db.Index('ix_registration_requests_pending', 'mac_address', db.text('submitted_at DESC'),
+                 postgresql_include=['email', 'first_name', 'last_name', 'phone_number',
+                                     'device_type', 'approval_token', 'ip_address'],
+                 postgresql_where=db.text("status = 'pending'")),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     mac_address = db.Column(db.String(17), nullable=False, index=True)
@@ -102,7 +229,7 @@ class RegistrationRequest(db.Model):
     ip_address = db.Column(db.String(45))
     user_agent = db.Column(db.Text)
     status = db.Column(db.String(50), default='pending')
-    approval_token = db.Column(db.String(255))
+    approval_token = db.Column(db.String(255), index=True)
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
     processed_at = db.Column(db.DateTime)
     processed_by = db.Column(db.String(100))
@@ -127,6 +254,21 @@ class VlanMapping(db.Model):
     
     def __repr__(self):
         return f'<VlanMapping {self.status} -> VLAN {self.vlan_id}>'
+    
+    @staticmethod
+    def get_map():
+        """Get status -> VLAN mappings (cached until the VLAN configuration changes)"""
+        check_settings_version()
+        return VlanMapping.load_map()
+    
+    @staticmethod
+    @cached(cache=_vlan_map_cache, lock=_vlan_map_cache_lock)
+    def load_map():
+        """Read the read-only VLAN map, with DEFAULT_VLAN_MAP filling in any unconfigured status"""
+        mappings = {m.status: m.vlan_id for m in VlanMapping.query}
+        if mappings:
+            return MappingProxyType(VlanMap({**DEFAULT_VLAN_MAP, **mappings}))
+        return DEFAULT_VLAN_MAP
 
 
 class Setting(db.Model):
@@ -142,17 +284,36 @@ class Setting(db.Model):
     
     @staticmethod
     def get_value(key, default=None):
-        """Get setting value with fallback to default"""
-        setting = Setting.query.get(key)
-        return setting.value if setting else default
+        """Get setting value with fallback to default (cached until a setting changes)"""
+        check_settings_version()
+        return Setting.load_all().get(key, default)
+    
+    @staticmethod
+    @cached(cache=_settings_cache, lock=_settings_cache_lock)
+    def load_all():
+        """Read every setting in one query (memoized in the settings cache)"""
+        rows = db.session.execute(db.select(Setting.key, Setting.value)).all()
+        return MappingProxyType(dict(rows))
     
     @staticmethod
     def set_value(key, value):
         """Set or update setting value"""
-        setting = Setting.query.get(key)
-        if setting:
-            setting.value = value
-        else:
-            setting = Setting(key=key, value=value)
-            db.session.add(setting)
+        Setting.set_values({key: value})
+    
+    @staticmethod
+    def set_values(values):
+        """
+        Set or update several settings in one statement and commit.
+        
+        Args:
+            values: dict of setting key -> value
+        """
+        stmt = pg_insert(Setting).values([{'key': key, 'value': value} for key, value in values.items()])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Setting.key],
+            set_={'value': stmt.excluded.value, 'updated_at': datetime.utcnow()}
+        )
+        db.session.execute(stmt)
         db.session.commit()
+        invalidate_config()
+        touch_settings_version()
@@ -4,10 +4,13 @@ Sends CoA packets to RADIUS server to change device VLANs
 """
 
 import os
+import time
+import socket
 import logging
-from pyrad.client import Client
+import threading
+from pyrad.client import Client, Timeout
 from pyrad.dictionary import Dictionary
-from pyrad.packet import CoARequest, Packet
+from pyrad.packet import CoARequest, CoAACK, DisconnectRequest, DisconnectACK, PacketError
 import io
 
 logger = logging.getLogger(__name__)
@@ -17,6 +20,10 @@ RADIUS_SERVER = os.getenv('RADIUS_SERVER', '192.168.99.4')
 RADIUS_SECRET = os.getenv('RADIUS_SECRET', 'testing123').encode('utf-8')
 RADIUS_NAS_IP = os.getenv('RADIUS_NAS_IP', '192.168.99.1')
 COA_PORT = 3799
+COA_TIMEOUT = float(os.getenv('RADIUS_COA_TIMEOUT', '2'))
+COA_RETRIES = int(os.getenv('RADIUS_COA_RETRIES', '3'))
+# RADIUS packet identifiers are one byte, so at most 256 requests can be in flight
+COA_BATCH_SIZE = 256
 
 # Create a minimal RADIUS dictionary
 DICT_CONTENT = """
@@ -33,26 +40,62 @@ VALUE Tunnel-Medium-Type IEEE-802 6
 """
 
 
+# Calling-Station-Id uses the NAS's AA-BB-CC-DD-EE-FF format
+COLON_TO_DASH = str.maketrans(':', '-')
+
+
+def calling_station_id(mac_address):
+    """Convert xx:xx:xx:xx:xx:xx to the XX-XX-XX-XX-XX-XX form the NAS expects"""
+    return mac_address.translate(COLON_TO_DASH).upper()
+
+
+# Parsed once at import rather than for every CoA
+RADIUS_DICTIONARY = Dictionary(io.StringIO(DICT_CONTENT))
+
+# One client (and UDP socket) per process, reused for every CoA.
+# Requests are serialized because replies are read from the shared socket.
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
 def get_radius_client():
-    """Create and return a RADIUS client"""
-    try:
-        # Create dictionary from string
-        dict_file = io.StringIO(DICT_CONTENT)
-        dict_obj = Dictionary(dict_file)
-        
-        # Create client
-        client = Client(
-            server=RADIUS_SERVER,
-            secret=RADIUS_SECRET,
-            dict=dict_obj,
-            authport=COA_PORT,
-            acctport=COA_PORT
-        )
-        
-        return client
-    except Exception as e:
-        logger.error(f"Failed to create RADIUS client: {e}")
-        return None
+    """Return this process's RADIUS client, creating it on first use"""
+    global _client, _client_pid
+    # Never reuse a socket inherited across fork (gunicorn/Celery prefork workers)
+    if _client is None or _client_pid != os.getpid():
+        try:
+            _client = Client(
+                server=RADIUS_SERVER,
+                secret=RADIUS_SECRET,
+                dict=RADIUS_DICTIONARY,
+                coaport=COA_PORT,
+                retries=COA_RETRIES,
+                timeout=COA_TIMEOUT
+            )
+            _client_pid = os.getpid()
+        except Exception as e:
+            logger.error("Failed to create RADIUS client: %s", e)
+            _client = None
+            return None
+    return _client
+
+
+def send_packet(req):
+    """Send a packet on the shared client and return the reply"""
+    with _client_lock:
+        return get_radius_client().SendPacket(req)
+
+
+def create_coa_change(client, mac_address, vlan_id):
+    """Build a CoA request that moves a device to a VLAN"""
+    req = client.CreateCoAPacket(code=CoARequest)
+    req['Calling-Station-Id'] = calling_station_id(mac_address)
+    req['NAS-IP-Address'] = RADIUS_NAS_IP
+    req['Tunnel-Type'] = 'VLAN'
+    req['Tunnel-Medium-Type'] = 'IEEE-802'
+    req['Tunnel-Private-Group-Id'] = str(vlan_id)
+    return req
 
 
 def send_coa_change(mac_address, vlan_id):
@@ -72,33 +115,114 @@ def send_coa_change(mac_address, vlan_id):
             logger.error("Failed to create RADIUS client")
             return False
         
-        # Create CoA request
-        req = client.CreateCoARequest()
+        req = create_coa_change(client, mac_address, vlan_id)
         
-        # Add attributes
-        req['Calling-Station-Id'] = mac_address.replace(':', '-').upper()
-        req['NAS-IP-Address'] = RADIUS_NAS_IP
-        req['Tunnel-Type'] = 'VLAN'
-        req['Tunnel-Medium-Type'] = 'IEEE-802'
-        req['Tunnel-Private-Group-Id'] = str(vlan_id)
-        
-        logger.info(f"Sending CoA to change {mac_address} to VLAN {vlan_id}")
+        logger.info("Sending CoA to change %s to VLAN %s", mac_address, vlan_id)
         
         # Send request
-        reply = client.SendPacket(req)
+        reply = send_packet(req)
         
-        if reply.code == Packet.CoAACK:
-            logger.info(f"CoA successful: {mac_address} -> VLAN {vlan_id}")
+        if reply.code == CoAACK:
+            logger.info("CoA successful: %s -> VLAN %s", mac_address, vlan_id)
             return True
         else:
-            logger.warning(f"CoA failed for {mac_address}: {reply.code}")
+            logger.warning("CoA failed for %s: %s", mac_address, reply.code)
             return False
-            
+    
+    except Timeout:
+        logger.error("CoA for %s timed out", mac_address)
+        return False
     except Exception as e:
-        logger.error(f"Error sending CoA for {mac_address}: {e}")
+        logger.error("Error sending CoA for %s: %s", mac_address, e)
         return False
 
 
+def send_coa_change_batch(changes):
+    """
+    Send CoA packets for several devices at once
+    
+    All requests are sent before any reply is awaited, so a batch costs
+    about one round trip instead of one per device. Unanswered requests are
+    resent together, waiting twice as long after each resend.
+    
+    Args:
+        changes: Iterable of (mac_address, vlan_id) pairs
+    
+    Returns:
+        list: (mac_address, vlan_id) pairs that were not acknowledged
+    """
+    changes = [tuple(change) for change in changes]
+    failed = []
+    for start in range(0, len(changes), COA_BATCH_SIZE):
+        failed.extend(send_coa_window(changes[start:start + COA_BATCH_SIZE]))
+    return failed
+
+
+def send_coa_window(changes):
+    """Send up to COA_BATCH_SIZE CoA requests on one socket and collect the replies"""
+    client = get_radius_client()
+    if not client:
+        logger.error("Failed to create RADIUS client")
+        return changes
+    
+    # Requests still waiting for a reply, keyed by packet identifier
+    pending = {}
+    failed = []
+    for mac_address, vlan_id in changes:
+        req = create_coa_change(client, mac_address, vlan_id)
+        raw = req.RequestPacket()
+        pending[req.id] = (req, raw, mac_address, vlan_id)
+    
+    logger.info("Sending %s CoA requests", len(pending))
+    
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((RADIUS_SERVER, COA_PORT))
+            for attempt in range(COA_RETRIES):
+                for _, raw, _, _ in pending.values():
+                    sock.send(raw)
+                
+                # Back off exponentially between resends so a congested NAS is not flooded
+                deadline = time.monotonic() + COA_TIMEOUT * 2 ** attempt
+                while pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    sock.settimeout(remaining)
+                    try:
+                        rawreply = sock.recv(4096)
+                    except socket.timeout:
+                        break
+                    
+                    entry = pending.get(rawreply[1]) if len(rawreply) > 1 else None
+                    if not entry:
+                        continue
+                    req, _, mac_address, vlan_id = entry
+                    try:
+                        reply = req.CreateReply(packet=rawreply)
+                        if not req.VerifyReply(reply, rawreply):
+                            continue
+                    except PacketError:
+                        continue
+                    
+                    del pending[reply.id]
+                    if reply.code == CoAACK:
+                        logger.info("CoA successful: %s -> VLAN %s", mac_address, vlan_id)
+                    else:
+                        logger.warning("CoA failed for %s: %s", mac_address, reply.code)
+                        failed.append((mac_address, vlan_id))
+                
+                if not pending:
+                    break
+    except OSError as e:
+        logger.error("Error sending CoA batch: %s", e)
+    
+    for _, _, mac_address, vlan_id in pending.values():
+        logger.error("CoA for %s timed out", mac_address)
+        failed.append((mac_address, vlan_id))
+    return failed
+
+
 def send_coa_disconnect(mac_address):
     """
     Send CoA packet to disconnect device
@@ -116,25 +240,27 @@ def send_coa_disconnect(mac_address):
             return False
         
         # Create disconnect request
-        req = client.CreateCoARequest()
-        req.code = 40  # Disconnect-Request
+        req = client.CreateCoAPacket(code=DisconnectRequest)
         
         # Add attributes
-        req['Calling-Station-Id'] = mac_address.replace(':', '-').upper()
+        req['Calling-Station-Id'] = calling_station_id(mac_address)
         req['NAS-IP-Address'] = RADIUS_NAS_IP
         
-        logger.info(f"Sending CoA disconnect for {mac_address}")
+        logger.info("Sending CoA disconnect for %s", mac_address)
         
         # Send request
-        reply = client.SendPacket(req)
+        reply = send_packet(req)
         
-        if reply.code == Packet.CoAACK:
-            logger.info(f"CoA disconnect successful: {mac_address}")
+        if reply.code == DisconnectACK:
+            logger.info("CoA disconnect successful: %s", mac_address)
             return True
         else:
-            logger.warning(f"CoA disconnect failed for {mac_address}: {reply.code}")
+            logger.warning("CoA disconnect failed for %s: %s", mac_address, reply.code)
             return False
-            
+    
+    except Timeout:
+        logger.error("CoA disconnect for %s timed out", mac_address)
+        return False
     except Exception as e:
-        logger.error(f"Error sending CoA disconnect for {mac_address}: {e}")
+        logger.error("Error sending CoA disconnect for %s: %s", mac_address, e)
         return False
@@ -0,0 +1,165 @@
+"""
+Background task queue for Captive Portal
+Runs slow external calls (email delivery, RADIUS CoA) outside the HTTP request cycle
+"""
+
+import os
+import logging
+from functools import lru_cache
+from celery import Celery
+
+from email_service import send_verification_email, send_admin_notification, send_wifi_registration_confirmation
+from radius_coa import send_coa_change_batch, send_coa_disconnect
+from kea_integration import get_kea_client
+
+logger = logging.getLogger(__name__)
+
+# Broker configuration - reuse the portal's Redis instance by default
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0'))
+
+# Kea control socket, shared with the web app; both containers mount ../kea/sockets here
+KEA_SOCKET = os.getenv('KEA_CONTROL_SOCKET', '/kea/sockets/kea4-ctrl-socket')
+
+celery_app = Celery('portal', broker=CELERY_BROKER_URL)
+celery_app.conf.update(
+    task_serializer='json',
+    accept_content=['json'],
+    task_ignore_result=True,
+    # Only acknowledge once a task has finished so a crashed worker's tasks are redelivered
+    task_acks_late=True,
+    task_routes={
+        'tasks.send_verification_email_task': {'queue': 'email'},
+        'tasks.send_admin_notification_task': {'queue': 'email'},
+        'tasks.send_wifi_confirmation_task': {'queue': 'email'},
+        'tasks.send_coa_change_batch_task': {'queue': 'radius'},
+        'tasks.send_coa_disconnect_task': {'queue': 'radius'},
+        'tasks.disconnect_device_task': {'queue': 'radius'},
+        'tasks.register_kea_mac_task': {'queue': 'kea'},
+        'tasks.unregister_kea_mac_task': {'queue': 'kea'},
+    },
+)
+
+
+class EmailDeliveryError(Exception):
+    """Raised when an email could not be delivered so the task is retried"""
+
+
+class CoAError(Exception):
+    """Raised when the NAS did not acknowledge a CoA request so the task is retried"""
+
+
+class KeaError(Exception):
+    """Raised when Kea rejected a reservation change so the task is retried"""
+
+
+@lru_cache(maxsize=1)
+def get_kea():
+    """Return the worker's Kea client, created on first use"""
+    return get_kea_client(control_socket=KEA_SOCKET)
+
+
+@celery_app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def send_verification_email_task(self, to_email, first_name, verification_url, timeout_minutes):
+    """Send the email verification link to a user"""
+    if not send_verification_email(to_email, first_name, verification_url, timeout_minutes):
+        raise EmailDeliveryError(f"Verification email to {to_email} was not delivered")
+
+
+@celery_app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def send_admin_notification_task(self, request_id, approval_url):
+    """Notify the admin about a new registration request"""
+    # Imported here to avoid a circular import (app imports tasks)
+    from app import app
+    from models import db, RegistrationRequest
+
+    with app.app_context():
+        reg_request = db.session.get(RegistrationRequest, request_id)
+        if not reg_request:
+            logger.warning("Registration request %s no longer exists, skipping admin notification", request_id)
+            return
+
+        if not send_admin_notification(reg_request, approval_url):
+            raise EmailDeliveryError(f"Admin notification for request {request_id} was not delivered")
+
+
+@celery_app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def send_wifi_confirmation_task(self, user_email, first_name, ssid, mac_address, unregister_url):
+    """Send the WiFi registration confirmation with the device's unregister link"""
+    if not send_wifi_registration_confirmation(user_email, first_name, ssid, mac_address, unregister_url):
+        raise EmailDeliveryError(f"WiFi confirmation to {user_email} was not delivered")
+
+
+@celery_app.task(bind=True, max_retries=3)
+def send_coa_change_batch_task(self, changes):
+    """Move several devices to new VLANs with one pipelined CoA batch"""
+    failed = send_coa_change_batch(changes)
+    if failed:
+        # Retry only the devices the NAS did not acknowledge
+        raise self.retry(
+            args=(failed,),
+            countdown=2 ** self.request.retries,
+            exc=CoAError(f"CoA batch: {len(failed)} of {len(changes)} changes were not acknowledged"),
+        )
+
+
+@celery_app.task(bind=True, max_retries=3)
+def send_coa_disconnect_task(self, mac_address):
+    """Disconnect a device via RADIUS CoA"""
+    if send_coa_disconnect(mac_address):
+        return
+
+    if self.request.retries < self.max_retries:
+        raise self.retry(
+            countdown=2 ** self.request.retries,
+            exc=CoAError(f"CoA disconnect for {mac_address} was not acknowledged"),
+        )
+
+    # The portal already recorded the device as blocked or deleted, so report that it may still be online
+    from app import app
+    from models import db, Device
+
+    with app.app_context():
+        device = db.session.execute(
+            db.select(Device.id, Device.registration_status).filter_by(mac_address=mac_address)
+        ).first()
+    if device:
+        logger.error("CoA disconnect for device %s (%s) failed after %s retries; it is recorded as %s "
+                     "but may still be connected", device.id, mac_address, self.max_retries, device.registration_status)
+    else:
+        logger.error("CoA disconnect for deleted device %s failed after %s retries; it may still be connected",
+                     mac_address, self.max_retries)
+
+
+@celery_app.task(bind=True, autoretry_for=(CoAError,), retry_backoff=True, max_retries=3)
+def disconnect_device_task(self, device_id):
+    """Disconnect a device via RADIUS CoA and record it as disconnected once the NAS acknowledges"""
+    # Imported here to avoid a circular import (app imports tasks)
+    from app import app
+    from models import db, Device, VlanMapping
+
+    with app.app_context():
+        device = db.session.get(Device, device_id)
+        if not device:
+            logger.warning("Device %s no longer exists, skipping disconnect", device_id)
+            return
+
+        if not send_coa_disconnect(device.mac_address):
+            raise CoAError(f"CoA disconnect for device {device_id} ({device.mac_address}) was not acknowledged")
+
+        device.registration_status = 'disconnected'
+        device.current_vlan = VlanMapping.get_map()['unregistered']
+        db.session.commit()
+
+
+@celery_app.task(bind=True, autoretry_for=(KeaError,), retry_backoff=True, max_retries=3)
+def register_kea_mac_task(self, mac_address, vlan_id):
+    """Add a Kea host reservation so a WiFi device is placed on its VLAN"""
+    if not get_kea().register_mac(mac_address, vlan_id):
+        raise KeaError(f"Kea reservation for {mac_address} on VLAN {vlan_id} failed")
+
+
+@celery_app.task(bind=True, autoretry_for=(KeaError,), retry_backoff=True, max_retries=3)
+def unregister_kea_mac_task(self, mac_address, vlan_id):
+    """Remove a WiFi device's Kea host reservation"""
+    if not get_kea().unregister_mac(mac_address, vlan_id):
+        raise KeaError(f"Removing Kea reservation for {mac_address} on VLAN {vlan_id} failed")
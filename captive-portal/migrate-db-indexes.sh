@@ -0,0 +1,80 @@
+#!/bin/bash
+#
+# Migration Script: Add lookup indexes to the captive portal database
+#
+# Creates the indexes declared in app/models.py on an existing database,
+# after bringing column types in line with the models.
+# Safe to run more than once (uses IF NOT EXISTS / type checks).
+
+set -e  # Exit on error
+
+# Colors for output
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+NC='\033[0m' # No Color
+
+CAPTIVE_PORTAL_DIR="$(cd "$(dirname "$0")" && pwd)"
+
+log_info() {
+    echo -e "${GREEN}[INFO]${NC} $1"
+}
+
+log_error() {
+    echo -e "${RED}[ERROR]${NC} $1"
+}
+
+log_info "Migrating captive_portal database..."
+
+if docker compose -f "$CAPTIVE_PORTAL_DIR/docker-compose.yml" exec -T db \
+    psql -v ON_ERROR_STOP=1 -U portal_user -d captive_portal <<-EOSQL
+        -- Verification tokens are stored as raw bytes; convert pending base64url tokens
+        DO \$\$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'devices' AND column_name = 'verification_token'
+                       AND data_type <> 'bytea') THEN
+                ALTER TABLE devices ALTER COLUMN verification_token TYPE BYTEA
+                USING decode(translate(verification_token, '-_', '+/')
+                             || repeat('=', (4 - length(verification_token) % 4) % 4), 'base64');
+            END IF;
+        END
+        \$\$;
+
+        -- Device lookups by MAC address (every portal request)
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_devices_mac_address
+        ON devices(mac_address);
+
+        -- Email verification link lookups (pending devices only)
+        CREATE INDEX IF NOT EXISTS ix_device_token_active
+        ON devices(verification_token)
+        WHERE verification_token IS NOT NULL;
+
+        -- A user's devices, optionally by status (admin edit, dashboard, cascade deletes);
+        -- the leading user_id column also serves plain user_id lookups
+        CREATE INDEX IF NOT EXISTS ix_device_user_status
+        ON devices(user_id, registration_status);
+        DROP INDEX IF EXISTS ix_devices_user_id;
+
+        -- Approval links in admin notification emails
+        CREATE INDEX IF NOT EXISTS ix_registration_requests_approval_token
+        ON registration_requests(approval_token);
+
+        -- Latest pending request per MAC (admin dashboard) and bulk approval by MAC;
+        -- covers the dashboard's columns so its pending list is an index-only scan
+        CREATE INDEX IF NOT EXISTS ix_registration_requests_pending
+        ON registration_requests(mac_address, submitted_at DESC)
+        INCLUDE (email, first_name, last_name, phone_number, device_type, approval_token, ip_address)
+        WHERE status = 'pending';
+
+        -- Admin users search (LIKE '%term%' over the combined user fields, see User.search_text)
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS ix_users_search_trgm
+        ON users USING gin (lower(email || ' ' || coalesce(first_name, '') || ' ' || coalesce(last_name, '')
+                                  || ' ' || coalesce(phone_number, '') || ' ' || status) gin_trgm_ops);
+EOSQL
+then
+    log_info "Migration completed successfully"
+else
+    log_error "Migration failed"
+    exit 1
+fi
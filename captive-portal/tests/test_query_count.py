@@ -0,0 +1,54 @@
+"""
+Query count regression tests for the admin dashboard
+
+Runs the app against an in-memory SQLite database with query recording enabled,
+so an N+1 in a dashboard table shows up as a failing bound rather than a log line.
+"""
+
+import os
+import sys
+from datetime import date
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ['SQLALCHEMY_RECORD_QUERIES'] = '1'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+import pytest
+from flask_sqlalchemy.record_queries import get_recorded_queries
+
+from app import app
+from models import db, User, Device
+
+# Count + page; more than this means rows are being loaded one by one
+DEVICES_TABLE_MAX_QUERIES = 2
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        for i in range(5):
+            user = User(email=f'user{i}@example.org', first_name='Test', last_name=f'User{i}',
+                        status='staff', begin_date=date(2020, 1, 1))
+            user.devices = [
+                Device(mac_address=f'aa:bb:cc:dd:{i:02x}:{j:02x}', registration_status='active', current_vlan=20)
+                for j in range(3)
+            ]
+            db.session.add(user)
+        db.session.commit()
+
+    with app.test_client() as client:
+        client.post('/admin/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+
+    with app.app_context():
+        db.drop_all()
+
+
+def test_devices_table_query_count(client):
+    response = client.get('/admin?ajax_table=devices', headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    assert response.status_code == 200
+    assert b'user4@example.org' in response.data
+    assert len(get_recorded_queries()) <= DEVICES_TABLE_MAX_QUERIES